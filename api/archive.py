@@ -0,0 +1,104 @@
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from .tokenizer import token_count
+from lib import strip_user_input_prefix
+
+_word_pattern = re.compile(r"\w+", re.UNICODE)
+# Common words match most archived messages and would use up the query's term limit.
+_stopwords = frozenset("""
+about above after again against all also and any are aren because been before being below
+between both but can cannot could did didn does doesn doing don down during each few for
+from further had hadn has hasn have haven having her here hers herself him himself his how
+into isn its itself just let like more most much mustn myself nor not now off once only
+other ought our ours ourselves out over own same shan she should shouldn some such than
+that the their theirs them themselves then there these they this those through too under
+until very was wasn were weren what when where which while who whom why will with won
+would wouldn yes yet you your yours yourself yourselves
+""".split())
+
+class ConversationArchive:
+    """
+    On-disk full-text index of messages folded out of users' message history, backed by
+    SQLite FTS5 and ranked with BM25. Searches use their own connection so they are not
+    blocked by writes. Both should run in an executor, searches go through `executor`.
+    """
+    def __init__(self, db_path, max_terms=16):
+        self.log = logging.getLogger(__name__)
+        self.db_path = db_path
+        self.max_terms = max_terms
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self.writer = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self.writer.execute("PRAGMA journal_mode=WAL")
+        self.writer.execute("PRAGMA synchronous=NORMAL")
+        self.writer.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS archive USING fts5("
+            "user_id, role UNINDEXED, content, archived_at UNINDEXED, "
+            "tokenize='porter unicode61')"
+        )
+        self.reader = sqlite3.connect(db_path, check_same_thread=False)
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="archive")
+
+    def add(self, user_id, messages):
+        rows = [(str(user_id), message.role.value, message.content, time.time()) for message in messages]
+        with self.lock:
+            self.writer.execute("BEGIN")
+            self.writer.executemany("INSERT INTO archive (user_id, role, content, archived_at) VALUES (?, ?, ?, ?)", rows)
+            self.writer.execute("COMMIT")
+
+    def delete(self, user_id):
+        with self.lock:
+            self.writer.execute("DELETE FROM archive WHERE user_id MATCH ?", (self.quote(user_id),))
+
+    def quote(self, term):
+        return '"' + str(term).replace('"', '""') + '"'
+
+    def build_query(self, user_id, text):
+        terms = []
+        # Only the message text is searched, timestamps and names would match every archived message.
+        for word in _word_pattern.findall(strip_user_input_prefix(text).lower()):
+            if len(word) < 3 or word.isdigit() or word in _stopwords or word in terms:
+                continue
+            terms.append(word)
+            if len(terms) == self.max_terms:
+                break
+        if not terms:
+            return None
+        return f"user_id : {self.quote(user_id)} AND content : ({' OR '.join(self.quote(term) for term in terms)})"
+
+    def search(self, user_id, text, top_k=3, max_tokens=256, model=None):
+        """
+        Returns up to top_k archived messages of the user that best match text, stopping
+        before their combined token count would exceed max_tokens.
+        """
+        query = self.build_query(user_id, text)
+        if query is None:
+            return []
+        try:
+            rows = self.reader.execute(
+                "SELECT role, content FROM archive WHERE archive MATCH ? ORDER BY bm25(archive, 0.0, 0.0, 1.0, 0.0) LIMIT ?",
+                (query, top_k)
+            ).fetchall()
+        except sqlite3.Error as e:
+            self.log.error(f"Error searching archive for user {user_id}: {e}")
+            return []
+        results = []
+        used = 0
+        for role, content in rows:
+            tokens = token_count(content, model)
+            if used + tokens > max_tokens:
+                break
+            used += tokens
+            results.append({'role': role, 'content': content})
+        return results
+
+    def close(self):
+        self.executor.shutdown()
+        with self.lock:
+            self.writer.close()
+        self.reader.close()
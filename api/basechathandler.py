@@ -1,105 +1,394 @@
 import asyncio
-import aiofiles
 import logging
-import pickle
+import random
+import time
+import metrics
+from .archive import ConversationArchive
+from .clientpool import provider_semaphore
+from .contextbudget import ContextBudget
 from .memory import Memory
-from .messagehandler import MessageHandler
+from .messagehandler import Message, MessageHandler, Role
 from .promptbuilder import PromptBuilder
+from .responsecache import ResponseCache, prompt_key
+from .ratelimiter import get_rate_limiter, retry_after
+from .summarizer import Summarizer
+from .threadstore import ThreadStore
+from .tokenizer import get_encoding, messages_token_count
+from lib import load_character_sheet, load_template, strip_user_input_prefix
 
 class BaseChatHandler:
-    def __init__(self, api_key, ai_name, template, summary_prompt="summary_prompt", model=None, max_tokens=512, temperature=1.0, top_p=1.0, memory_max_tokens=16384, memory_model=None, **kwargs):
+    provider = None
+
+    def __init__(self, api_key, ai_name, template, summary_prompt="summary_prompt", model=None, max_tokens=512, temperature=1.0, top_p=1.0, memory_max_tokens=16384, memory_high_watermark=None, memory_low_watermark=None, memory_model=None, summary_concurrency=2, memory_cache_size=1024, stream=False, max_concurrent_requests=16, http_max_connections=100, requests_per_minute=None, tokens_per_minute=None, max_retries=4, prompt_layout="default", context_window=None, retrieval_top_k=0, retrieval_max_tokens=256, response_cache_size=0, response_cache_ttl=3600.0, **kwargs):
         self.api_key = api_key
         self.ai_name = ai_name
         self.model = model
         self.max_tokens = max_tokens
         self.temperature = temperature
         self.top_p = top_p
-        self.user_threads = {}
+        self.stream = stream
+        self.memory_cache_size = memory_cache_size
+        self.user_threads = None
         self.log = logging.getLogger(__name__)
         self.messages = MessageHandler()
-        self.prompt_builder = PromptBuilder(ai_name, template, self.messages)
+        self.prompt_builder = PromptBuilder(ai_name, template, self.messages, prompt_layout, ContextBudget(model, max_tokens, context_window), memory_cache_size)
+        self.prompt_tokens = 0
+        self.cached_prompt_tokens = 0
+        self.http_options = {'max_connections': http_max_connections}
+        self.semaphore = provider_semaphore(self.provider, max_concurrent_requests)
+        self.rate_limiter = get_rate_limiter((self.provider, api_key), requests_per_minute, tokens_per_minute)
+        self.max_retries = max_retries
         self.client = self.initialize_client()
         self.memory_config = {
             'ai_name': self.ai_name,
             'summary_prompt': summary_prompt,
-            'llm': self.client,
+            'llm': self.create_completion,
             'model': memory_model or model,
             'temperature': 0.4,
             'top_p': 0.9,
-            'max_tokens': memory_max_tokens
+            'max_tokens': memory_max_tokens,
+            'high_watermark': memory_high_watermark,
+            'low_watermark': memory_low_watermark
         }
-    
+        self.summarizer = Summarizer(summary_concurrency, on_complete=self.on_summary_updated)
+        self.retrieval_top_k = retrieval_top_k
+        self.retrieval_max_tokens = retrieval_max_tokens
+        self.archive = ConversationArchive(f'./logs/{self.ai_name}/archive.db') if retrieval_top_k else None
+        self.response_cache = ResponseCache("response", response_cache_size, response_cache_ttl) if response_cache_size else None
+
         self.load_user_threads()
 
     def initialize_client(self):
         raise NotImplementedError("Subclasses should implement this method")
 
-    async def save_user_threads(self):
+    async def warmup(self):
+        """
+        Loads the tokenizer, reads the templates into the file cache and opens the provider
+        connections, so the first reply does not pay for them. The steps run concurrently,
+        returns the seconds each of them took.
+        """
+        loop = asyncio.get_running_loop()
+        timings = {}
+
+        async def timed(step, awaitable):
+            started = time.perf_counter()
+            try:
+                await awaitable
+            except Exception as e:
+                self.log.warning(f"Warmup step {step} failed: {e}")
+            timings[step] = time.perf_counter() - started
+
+        await asyncio.gather(
+            timed("tokenizer", loop.run_in_executor(None, self.load_tokenizers)),
+            timed("templates", loop.run_in_executor(None, self.load_templates)),
+            timed("connections", self.open_connections())
+        )
+        return timings
+
+    def load_tokenizers(self):
+        for model in {self.model, self.memory_config['model']}:
+            get_encoding(model)
+
+    def load_templates(self):
+        load_template(self.prompt_builder.template)
+        load_template(self.memory_config['summary_prompt'])
+        load_character_sheet(self.ai_name)
+
+    def provider_clients(self):
+        return [self.client] if self.client is not None else []
+
+    async def open_connections(self):
+        # Listing models is a cheap authenticated request that leaves a warm TLS connection in the pool.
+        clients = [client for client in self.provider_clients() if hasattr(client, 'models')]
+        await asyncio.gather(*(client.models.list() for client in clients))
+
+    async def save_user_threads(self, user_id):
+        memory = self.user_threads.peek(user_id)
+        if memory is None:
+            return
         try:
-            async with aiofiles.open(f'./logs/{self.ai_name}/user_threads.pkl', 'wb') as file:
-                await file.write(pickle.dumps(self.user_threads))
+            with metrics.span("thread_serialize"):
+                data = self.user_threads.serialize(memory)
+            with metrics.span("thread_write"):
+                await asyncio.get_running_loop().run_in_executor(self.user_threads.executor, self.user_threads.write, user_id, data)
         except Exception as e:
-            self.log.error(f"Error saving user threads: {e}")
+            self.log.error(f"Error saving user thread for user {user_id}: {e}")
+
+    @classmethod
+    def prepare_shared_state(cls, ai_name, **kwargs):
+        """
+        One-time setup of state shared by handlers running in several processes, called
+        before the processes are started.
+        """
+        user_threads = ThreadStore(f'./logs/{ai_name}/user_threads.db')
+        try:
+            user_threads.migrate_pickle(f'./logs/{ai_name}/user_threads.pkl')
+        finally:
+            user_threads.close()
 
     def load_user_threads(self):
+        self.user_threads = ThreadStore(
+            f'./logs/{self.ai_name}/user_threads.db',
+            cache_size=self.memory_cache_size,
+            on_load=lambda memory: memory.reinit(**self.memory_config)
+        )
         try:
-            with open(f'./logs/{self.ai_name}/user_threads.pkl', 'rb') as file:
-                loaded_user_threads = pickle.load(file)
-            for user_id, memory in loaded_user_threads.items():
-                memory.reinit(**self.memory_config)
-            self.user_threads = loaded_user_threads
-        except FileNotFoundError:
-            self.user_threads = {}
+            self.user_threads.migrate_pickle(f'./logs/{self.ai_name}/user_threads.pkl')
         except Exception as e:
-            self.log.error(f"Error loading user threads: {e}")
-            self.user_threads = {}
+            self.log.error(f"Error migrating user threads: {e}")
 
     def update_memory(self, user, messages):
         (user_id, user_name), = user.items()
         memory = self.get_user_thread(user_id)
-        memory.update(messages, user)
-        self.user_threads[user_id] = memory
+        self.summarizer.record_turn()
+        if memory.update(messages, user):
+            self.summarizer.schedule(user, memory)
+
+    async def on_summary_updated(self, user_id, memory, folded):
+        cached = self.user_threads.peek(user_id)
+        if cached is None:
+            # Evicted from the LRU while the summary ran, summaries of reset threads are discarded by the summarizer.
+            self.user_threads.put(user_id, memory)
+        elif cached is not memory:
+            self.log.debug(f"Thread for user {user_id} was reset during summary update, discarding it")
+            return
+        self.log.debug(f"Saving summary for user {user_id}")
+        await self.save_user_threads(user_id)
+        if self.archive is not None:
+            await self.archive_messages(user_id, folded)
+
+    async def archive_messages(self, user_id, messages):
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self.archive.add, user_id, messages)
+        except Exception as e:
+            self.log.error(f"Error archiving messages for user {user_id}: {e}")
 
     def get_user_thread(self, user_id):
-        return self.user_threads.get(
-            user_id,
-            Memory(**self.memory_config)
-        )
+        memory = self.user_threads.get(user_id)
+        if memory is None:
+            memory = Memory(**self.memory_config)
+            self.user_threads.put(user_id, memory)
+        return memory
+
+    async def get_training_example(self, user_id, user_name, response):
+        """
+        Returns the system, user and assistant messages of the turn that produced response,
+        taken from the user's message history, or None once the turn has been summarized.
+        """
+        memory = self.user_threads.get(user_id)
+        if memory is None:
+            return None
+        history = memory.message_history
+        for index in range(len(history) - 1, 0, -1):
+            reply, user_turn = history[index], history[index - 1]
+            if reply.role is Role.ASSISTANT and user_turn.role is Role.USER and reply.content == response:
+                system = Message(Role.SYSTEM, self.prompt_builder.render_static_message(user_id, user_name))
+                return [system.to_dict(), user_turn.to_dict(), reply.to_dict()]
+        return None
 
     async def reset_thread(self, user_id):
-        if user_id in self.user_threads:
-            del self.user_threads[user_id]
-        await self.save_user_threads()
+        self.summarizer.discard(user_id)
+        self.user_threads.evict(user_id)
+        try:
+            await asyncio.get_running_loop().run_in_executor(self.user_threads.executor, self.user_threads.remove, user_id)
+        except Exception as e:
+            self.log.error(f"Error resetting user thread for user {user_id}: {e}")
+        if self.archive is not None:
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, self.archive.delete, user_id)
+            except Exception as e:
+                self.log.error(f"Error deleting archived messages for user {user_id}: {e}")
 
-    async def get_ai_response(self, user_input, user):
+    async def close(self):
+        await self.summarizer.drain()
+        self.user_threads.close()
+        if self.archive is not None:
+            self.archive.close()
+
+    async def create_completion(self, prompt_tokens=None, **params):
+        async with self.semaphore:
+            return await self.send_request(params, prompt_tokens)
+
+    async def send_request(self, params, prompt_tokens=None):
+        return await self.request_completion(self.client, self.rate_limiter, params, self.max_retries, prompt_tokens)
+
+    async def request_completion(self, client, rate_limiter, params, max_retries, prompt_tokens=None):
+        """
+        Sends a chat completion request once the rate limiter has budget for it, retrying
+        rate-limited and transient failures with jittered exponential backoff. prompt_tokens
+        is the prompt's token count when the caller already knows it, otherwise it is counted.
+        """
+        if prompt_tokens is None:
+            with metrics.span("token_count"):
+                prompt_tokens = messages_token_count(params['messages'], params.get('model'))
+        estimated_tokens = prompt_tokens + params.get('max_tokens', 0)
+        for attempt in range(max_retries + 1):
+            with metrics.span("rate_limit_wait"):
+                await rate_limiter.acquire(estimated_tokens)
+            metrics.increment("provider_requests_total", provider=self.provider)
+            try:
+                raw_response = await client.chat.completions.with_raw_response.create(**params)
+                rate_limiter.update_from_headers(raw_response.headers)
+                response = raw_response.parse()
+                if not params.get('stream'):
+                    self.record_usage(getattr(response, 'usage', None))
+                return response
+            except Exception as e:
+                delay = self.retry_delay(e, attempt, rate_limiter)
+                if delay is None or attempt == max_retries:
+                    metrics.increment("provider_errors_total", provider=self.provider)
+                    raise
+                metrics.increment("provider_retries_total", provider=self.provider)
+                self.log.warning(f"Request failed ({e}), retrying in {delay:.2f}s ({attempt + 1}/{max_retries})")
+                await asyncio.sleep(delay)
+
+    def record_usage(self, usage):
+        if usage is None:
+            return
+        details = getattr(usage, 'prompt_tokens_details', None)
+        cached_tokens = getattr(details, 'cached_tokens', None) or 0
+        self.prompt_tokens += usage.prompt_tokens
+        self.cached_prompt_tokens += cached_tokens
+        metrics.increment("tokens_in_total", usage.prompt_tokens)
+        metrics.increment("tokens_cached_total", cached_tokens)
+        metrics.increment("tokens_out_total", usage.completion_tokens)
+        hit_rate = self.cached_prompt_tokens / self.prompt_tokens if self.prompt_tokens else 0.0
+        self.log.info(f"Prompt tokens: {usage.prompt_tokens}, cached: {cached_tokens}, completion tokens: {usage.completion_tokens}, cache hit rate: {hit_rate:.1%}")
+
+    def retry_delay(self, error, attempt, rate_limiter):
+        status = getattr(error, 'status_code', None)
+        if status is None:
+            # Errors raised while talking to the API without an HTTP status are connection errors and timeouts.
+            if getattr(error, 'request', None) is None:
+                return None
+        elif status not in (408, 409, 429) and status < 500:
+            return None
+        delay = random.uniform(0, min(30.0, 2 ** attempt))
+        response = getattr(error, 'response', None)
+        requested = retry_after(response.headers) if response is not None else None
+        if requested is not None:
+            delay = requested * random.uniform(1.0, 1.2)
+        if status == 429:
+            rate_limiter.penalize(delay)
+        return delay
+
+    async def prepare_prompt(self, user_input, user):
         if not self.model:
             raise ValueError("Model is not set.")
-        
+
         self.log.debug(user)
         (user_id, user_name), = user.items()
-        user_input = self.messages.create_message(user_input, role="user")
-        prompt = self.prompt_builder.build_prompt(user, user_input, self.get_user_thread(user_id))
-        try:
-            response = await asyncio.get_running_loop().run_in_executor(
-                None,
-                lambda: self.client.chat.completions.create(
-                    model=self.model,
-                    messages=prompt,
-                    max_tokens=self.max_tokens,
-                    temperature=self.temperature,
-                    top_p=self.top_p
+        recalled = None
+        if self.archive is not None:
+            with metrics.span("archive_search"):
+                recalled = await asyncio.get_running_loop().run_in_executor(
+                    self.archive.executor, self.archive.search, user_id, user_input, self.retrieval_top_k, self.retrieval_max_tokens, self.model
                 )
-            )
-            self.log.debug(f"Response: {response}")
-        except Exception as e:
-            self.log.error(f"Error getting response: {e}")
-            return "An error occurred."
-        response = response.choices[0].message
-        response = self.messages.create_message(response.content, response.role)
+        user_input = self.messages.create_message(user_input, role="user", trusted=isinstance(user_input, str))
+        prompt = self.prompt_builder.build_prompt(user, user_input, self.get_user_thread(user_id), recalled)
+        # The budget's count of the fitted prompt is built from cached counts, so requests need not count it again.
+        report = self.prompt_builder.last_budget_report
+        return user_input, prompt, report['used'] if report else None
+
+    def completion_params(self, prompt):
+        return {
+            'model': self.model,
+            'messages': prompt,
+            'max_tokens': self.max_tokens,
+            'temperature': self.temperature,
+            'top_p': self.top_p
+        }
+
+    async def finish_turn(self, user, user_input, content, role="assistant"):
+        (user_id, user_name), = user.items()
+        response = self.messages.create_message(content, role)
         user_input.extend(response)
         self.log.debug(f"Updating memory for user {user_id}")
         self.update_memory(user, user_input)
         self.log.debug(f"Saving memory for user {user_id}")
-        await self.save_user_threads()
+        await self.save_user_threads(user_id)
+        return str(response[0].content)
+
+    def cached_response(self, user, user_input, params):
+        """
+        Returns the response cache key of the turn and the reply cached for it, if any. Only
+        the first turn of a conversation is cached, keyed by the parts of the prompt that
+        repeat between users and sessions: the static system message and the input text
+        without its timestamp. Later turns depend on the conversation and are not looked up.
+        """
+        if self.response_cache is None:
+            return None, None
+        (user_id, user_name), = user.items()
+        memory = self.user_threads.peek(user_id)
+        prompt = params['messages']
+        if memory is None or memory.summary or memory.message_history or len(prompt) != 2:
+            return None, None
+        key = prompt_key({
+            **params,
+            'messages': [prompt[0], {'role': "user", 'content': strip_user_input_prefix(user_input[0].content)}]
+        })
+        content = self.response_cache.get(key)
+        if content is not None:
+            self.log.info(f"Reusing cached response, response cache stats: {self.response_cache.stats()}")
+        return key, content
+
+    def cache_response(self, key, content):
+        if key is not None and content:
+            self.response_cache.put(key, content)
+
+    async def get_ai_response(self, user_input, user):
+        with metrics.span("prepare_prompt"):
+            user_input, prompt, prompt_tokens = await self.prepare_prompt(user_input, user)
+        params = self.completion_params(prompt)
+        key, content = self.cached_response(user, user_input, params)
+        if content is not None:
+            with metrics.span("finish_turn"):
+                return await self.finish_turn(user, user_input, content)
+        try:
+            with metrics.span("llm_call"):
+                response = await self.create_completion(prompt_tokens, **params)
+            self.log.debug(f"Response: {response}")
+        except Exception:
+            # Raised like the assistants handler does, so callers never take an error for a reply.
+            metrics.increment("reply_errors_total")
+            raise
+        response = response.choices[0].message
+        self.cache_response(key, response.content)
+        with metrics.span("finish_turn"):
+            response = await self.finish_turn(user, user_input, response.content, response.role)
         self.log.debug(f"Returning response to telegram bot.")
-        return str(response[0]['content'])
\ No newline at end of file
+        return response
+
+    async def stream_ai_response(self, user_input, user):
+        """
+        Yields the reply as text deltas while it is generated. Memory is only updated
+        with the fully assembled reply once the stream has completed.
+        """
+        with metrics.span("prepare_prompt"):
+            user_input, prompt, prompt_tokens = await self.prepare_prompt(user_input, user)
+        params = self.completion_params(prompt)
+        key, cached = self.cached_response(user, user_input, params)
+        if cached is not None:
+            yield cached
+            with metrics.span("finish_turn"):
+                await self.finish_turn(user, user_input, cached)
+            return
+        content = []
+        async with self.semaphore:
+            params = dict(params, stream=True)
+            if self.provider == 'openai':
+                params['stream_options'] = {'include_usage': True}
+            stream = await self.send_request(params, prompt_tokens)
+            async for chunk in stream:
+                if not chunk.choices:
+                    self.record_usage(getattr(chunk, 'usage', None))
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    content.append(delta)
+                    yield delta
+        content = "".join(content)
+        self.cache_response(key, content)
+        with metrics.span("finish_turn"):
+            await self.finish_turn(user, user_input, content)
+        self.log.debug(f"Finished streaming response to telegram bot.")
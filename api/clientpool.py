@@ -0,0 +1,60 @@
+import asyncio
+import httpx
+
+_http_client = None
+_clients = {}
+_semaphores = {}
+
+def get_http_client(max_connections=100, max_keepalive_connections=20, keepalive_expiry=30.0, timeout=60.0):
+    """
+    Returns the process-wide async HTTP client shared by all provider SDK clients.
+    The pool settings of the first caller win.
+    """
+    global _http_client
+    if _http_client is None:
+        _http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_keepalive_connections,
+                keepalive_expiry=keepalive_expiry
+            ),
+            timeout=httpx.Timeout(timeout, connect=10.0)
+        )
+    return _http_client
+
+def create_client(provider, api_key, **http_options):
+    """
+    Returns an async SDK client for the provider, reusing an existing one for the same
+    api key. Provider SDKs are only imported when first used. The SDKs' own retries are
+    disabled, retries are handled by BaseChatHandler.send_request.
+    """
+    key = (provider, api_key)
+    client = _clients.get(key)
+    if client is None:
+        http_client = get_http_client(**http_options)
+        if provider == 'openai':
+            from openai import AsyncOpenAI
+            client = AsyncOpenAI(api_key=api_key, http_client=http_client, max_retries=0)
+        elif provider == 'groq':
+            from groq import AsyncGroq
+            client = AsyncGroq(api_key=api_key, http_client=http_client, max_retries=0)
+        else:
+            raise ValueError(f"Unknown provider: {provider}")
+        _clients[key] = client
+    return client
+
+def provider_semaphore(provider, limit):
+    """
+    Returns the semaphore capping in-flight requests to a provider across all handlers.
+    """
+    semaphore = _semaphores.get(provider)
+    if semaphore is None:
+        semaphore = _semaphores[provider] = asyncio.Semaphore(limit)
+    return semaphore
+
+async def close_clients():
+    global _http_client
+    _clients.clear()
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
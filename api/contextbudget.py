@@ -0,0 +1,86 @@
+import logging
+from .messagehandler import Role
+from .tokenizer import message_token_count, token_count
+
+# Context lengths of commonly configured models. Names are matched exactly first, then
+# by the longest known prefix, so dated snapshots like gpt-4o-2024-08-06 resolve too.
+MODEL_CONTEXT_WINDOWS = {
+    'gpt-4o': 128000,
+    'gpt-4o-mini': 128000,
+    'gpt-4-turbo': 128000,
+    'gpt-4-32k': 32768,
+    'gpt-4': 8192,
+    'gpt-3.5-turbo': 16385,
+    'gpt-3.5-turbo-instruct': 4096,
+    'llama3-8b-8192': 8192,
+    'llama3-70b-8192': 8192,
+    'llama-3.1-8b-instant': 131072,
+    'llama-3.1-70b-versatile': 131072,
+    'mixtral-8x7b-32768': 32768,
+    'gemma-7b-it': 8192,
+    'gemma2-9b-it': 8192,
+}
+DEFAULT_CONTEXT_WINDOW = 8192
+# Tokens the chat format adds around every message.
+MESSAGE_OVERHEAD = 4
+
+def context_window(model):
+    if model in MODEL_CONTEXT_WINDOWS:
+        return MODEL_CONTEXT_WINDOWS[model]
+    prefixes = [name for name in MODEL_CONTEXT_WINDOWS if model and model.startswith(name)]
+    if prefixes:
+        return MODEL_CONTEXT_WINDOWS[max(prefixes, key=len)]
+    return DEFAULT_CONTEXT_WINDOW
+
+class ContextBudget:
+    """
+    Fits a prompt into the model's context window after reserving room for the
+    completion. Parts are kept in priority order: system message and new input,
+    then the summary, then history from newest to oldest.
+    """
+    def __init__(self, model, max_tokens, window=None, safety_margin=64):
+        self.log = logging.getLogger(__name__)
+        self.model = model
+        self.window = window or context_window(model)
+        self.limit = self.window - max_tokens - safety_margin
+
+    def count(self, message):
+        return message_token_count(message, self.model) + MESSAGE_OVERHEAD
+
+    def count_text(self, text):
+        return token_count(text, self.model)
+
+    def fit(self, system_tokens, summary_tokens, history, history_counts, user_input):
+        """
+        Returns (summary_kept, first_history_index, report). system_tokens and summary_tokens
+        are the counts of the system message and the summary message, None without a summary,
+        so counts cached by the caller are not recomputed every turn. summary_kept is False
+        when the summary had to be dropped, and history[first_history_index:] is the part of
+        the history that fits. report['used'] is the token count of the fitted prompt.
+        """
+        used = system_tokens + MESSAGE_OVERHEAD + sum(self.count(message) for message in user_input)
+        report = {'limit': self.limit, 'trimmed_messages': 0, 'trimmed_tokens': 0, 'summary_dropped': False}
+
+        summary_kept = summary_tokens is not None
+        if summary_kept:
+            summary_tokens += MESSAGE_OVERHEAD
+            if used + summary_tokens <= self.limit:
+                used += summary_tokens
+            else:
+                summary_kept = False
+                report['summary_dropped'] = True
+                report['trimmed_tokens'] += summary_tokens
+
+        start = len(history)
+        kept_tokens = 0
+        while start > 0 and used + kept_tokens + history_counts[start - 1] + MESSAGE_OVERHEAD <= self.limit:
+            start -= 1
+            kept_tokens += history_counts[start] + MESSAGE_OVERHEAD
+        # Never start the kept history on an assistant reply to a dropped user message.
+        while 0 < start < len(history) and history[start].role is not Role.USER:
+            kept_tokens -= history_counts[start] + MESSAGE_OVERHEAD
+            start += 1
+        report['trimmed_messages'] = start
+        report['trimmed_tokens'] += sum(history_counts[:start]) + MESSAGE_OVERHEAD * start
+        report['used'] = used + kept_tokens
+        return summary_kept, start, report
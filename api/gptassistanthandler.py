@@ -1,82 +1,146 @@
-import json
-import time
-from openai import OpenAI
-from .basechathandler import BaseChatHandler
-from lib import load_character_sheet
-
-class GPTAssistantHandler(BaseChatHandler):
-    def __init__(self, api_key, assistant_id, ai_name, user_threads_file, **kwargs):
-        self.assistant_id = assistant_id
-        self.user_threads_file = user_threads_file
-        super().__init__(api_key, ai_name, None, **kwargs)
-
-    def initialize_client(self):
-        return OpenAI(api_key=self.api_key)
-
-    async def get_ai_response(self, user_input, user):
-        (user_id, user_name), = user.items()
-        thread_id = self.get_thread(user_id)
-        try:
-            self.log.info("Getting response from OpenAI API")
-            response = self.get_openai_response(user_input, thread_id)
-            return response
-        except Exception as e:
-            self.log.error("Error sending message to OpenAI: %s", str(e), exc_info=True)
-            raise Exception("An error occurred sending message to OpenAI") from e
-
-    def get_thread(self, user_id):
-        user_threads = self.load_user_threads()
-        if user_id not in user_threads:
-            self.create_thread(user_id)
-            user_threads = self.load_user_threads()
-        return user_threads[user_id]
-
-    def create_thread(self, user_id):
-        self.log.info("No thread found for user %s, creating a new one.", user_id)
-        thread = self.client.beta.threads.create()
-        user_threads = self.load_user_threads()
-        user_threads[user_id] = thread.id
-        self.save_user_threads(user_threads)
-        self.init_new_thread(user_id)
-
-    def save_user_threads(self, user_threads):
-        with open(self.user_threads_file, 'w') as file:
-            json.dump(user_threads, file)
-            self.log.info("Saved user threads to file: %s", user_threads)
-
-    def init_new_thread(self, user_id):
-        thread_id = self.get_thread(user_id)
-        try:
-            self.log.debug("Initializing new thread: %s", user_id)
-            self.client.beta.threads.messages.create(
-                thread_id=thread_id,
-                role="user",
-                content=load_character_sheet(self.ai_name, user_id)
-            )
-        except Exception as e:
-            self.log.error("Error initializing new thread: %s", str(e), exc_info=True)
-    
-    def get_openai_response(self, user_input, thread_id):
-        try:
-            self.client.beta.threads.messages.create(
-                thread_id=thread_id,
-                role="user",
-                content=user_input
-            )
-            run = self.client.beta.threads.runs.create(thread_id=thread_id, assistant_id=self.assistant_id)
-            self.wait_for_run_completion(self.client, thread_id, run.id)
-            messages = self.client.beta.threads.messages.list(thread_id=thread_id)
-            response = messages.data[0].content[0].text.value if messages.data[0].role == "assistant" else "No response."
-            return response
-        except Exception as e:
-            self.log.error("Error getting response from OpenAI: %s", str(e), exc_info=True)
-            raise Exception("An error occurred in GPT response") from e
-
-    def wait_for_run_completion(self, client, thread_id, run_id):
-        timeout = 60 * 10
-        while timeout >= 0:
-            timeout -= 1
-            run = client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run_id)
-            if run.status == "completed":
-                break
-            time.sleep(1)
\ No newline at end of file
+import asyncio
+import json
+import os
+from .basechathandler import BaseChatHandler
+from .clientpool import create_client
+from lib import load_character_sheet, load_json
+
+TERMINAL_RUN_STATUSES = {"completed", "failed", "cancelled", "expired", "incomplete"}
+
+class GPTAssistantHandler(BaseChatHandler):
+    provider = 'openai'
+
+    def __init__(self, api_key, assistant_id, ai_name, user_threads_file, template=None, run_poll_interval=0.25, run_max_poll_interval=2.0, run_timeout=600, **kwargs):
+        self.assistant_id = assistant_id
+        self.user_threads_file = user_threads_file
+        self.run_poll_interval = run_poll_interval
+        self.run_max_poll_interval = run_max_poll_interval
+        self.run_timeout = run_timeout
+        self.thread_locks = {}
+        super().__init__(api_key, ai_name, template, **kwargs)
+        self.stream = False
+
+    def initialize_client(self):
+        return create_client(self.provider, self.api_key, **self.http_options)
+
+    def load_tokenizers(self):
+        # Prompts are assembled by the assistants api, nothing is counted or rendered locally.
+        pass
+
+    def load_templates(self):
+        pass
+
+    async def get_ai_response(self, user_input, user):
+        (user_id, user_name), = user.items()
+        try:
+            thread_id = await self.get_thread(user_id)
+            self.log.info("Getting response from OpenAI API")
+            response = await self.get_openai_response(user_input, thread_id)
+            return response
+        except Exception as e:
+            self.log.error("Error sending message to OpenAI: %s", str(e), exc_info=True)
+            raise Exception("An error occurred sending message to OpenAI") from e
+
+    async def request(self, method, **params):
+        async with self.semaphore:
+            return await method(**params)
+
+    @classmethod
+    def prepare_shared_state(cls, **kwargs):
+        pass
+
+    def load_user_threads(self):
+        self.user_threads = load_json(self.user_threads_file)
+
+    async def save_user_threads(self, user_id=None):
+        data = json.dumps(self.user_threads)
+        await asyncio.get_running_loop().run_in_executor(None, self.write_user_threads, data)
+        self.log.info("Saved user threads to file: %s", self.user_threads_file)
+
+    def write_user_threads(self, data):
+        temp_file = f"{self.user_threads_file}.tmp"
+        with open(temp_file, 'w') as file:
+            file.write(data)
+        os.replace(temp_file, self.user_threads_file)
+
+    async def close(self):
+        pass
+
+    async def get_training_example(self, user_id, user_name, response):
+        # Conversations are kept in assistants api threads, there is no local history to pair replies from.
+        return None
+
+    async def reset_thread(self, user_id):
+        if self.user_threads.pop(user_id, None) is not None:
+            await self.save_user_threads()
+
+    async def get_thread(self, user_id):
+        thread_id = self.user_threads.get(user_id)
+        if thread_id is not None:
+            return thread_id
+        lock = self.thread_locks.setdefault(user_id, asyncio.Lock())
+        async with lock:
+            if user_id not in self.user_threads:
+                await self.create_thread(user_id)
+        self.thread_locks.pop(user_id, None)
+        return self.user_threads[user_id]
+
+    async def create_thread(self, user_id):
+        self.log.info("No thread found for user %s, creating a new one.", user_id)
+        thread = await self.request(self.client.beta.threads.create)
+        self.user_threads[user_id] = thread.id
+        await self.save_user_threads()
+        await self.init_new_thread(user_id, thread.id)
+
+    async def init_new_thread(self, user_id, thread_id):
+        character_sheet = load_character_sheet(self.ai_name, user_id)
+        if not character_sheet:
+            return
+        try:
+            self.log.debug("Initializing new thread: %s", user_id)
+            await self.request(
+                self.client.beta.threads.messages.create,
+                thread_id=thread_id,
+                role="user",
+                content=character_sheet
+            )
+        except Exception as e:
+            self.log.error("Error initializing new thread: %s", str(e), exc_info=True)
+
+    async def get_openai_response(self, user_input, thread_id):
+        try:
+            await self.request(
+                self.client.beta.threads.messages.create,
+                thread_id=thread_id,
+                role="user",
+                content=user_input
+            )
+            run = await self.request(self.client.beta.threads.runs.create, thread_id=thread_id, assistant_id=self.assistant_id)
+            run = await self.wait_for_run_completion(thread_id, run)
+            if run.status != "completed":
+                raise Exception(f"Run {run.id} ended with status {run.status}: {run.last_error}")
+            messages = await self.request(self.client.beta.threads.messages.list, thread_id=thread_id, run_id=run.id, limit=1)
+            if not messages.data or messages.data[0].role != "assistant":
+                return "No response."
+            return messages.data[0].content[0].text.value
+        except Exception as e:
+            self.log.error("Error getting response from OpenAI: %s", str(e), exc_info=True)
+            raise Exception("An error occurred in GPT response") from e
+
+    async def wait_for_run_completion(self, thread_id, run):
+        """
+        Polls the run with exponential backoff until it reaches a terminal status. Runs
+        that need tool outputs, which this handler cannot provide, or that exceed
+        run_timeout are cancelled.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.run_timeout
+        delay = self.run_poll_interval
+        while run.status not in TERMINAL_RUN_STATUSES:
+            if run.status == "requires_action" or loop.time() >= deadline:
+                self.log.warning("Cancelling run %s with status %s", run.id, run.status)
+                return await self.request(self.client.beta.threads.runs.cancel, thread_id=thread_id, run_id=run.id)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.run_max_poll_interval)
+            run = await self.request(self.client.beta.threads.runs.retrieve, thread_id=thread_id, run_id=run.id)
+        return run
@@ -1,6 +1,8 @@
-from openai import OpenAI
 from .basechathandler import BaseChatHandler
+from .clientpool import create_client
 
 class GPTChatHandler(BaseChatHandler):
+    provider = 'openai'
+
     def initialize_client(self):
-        return OpenAI(api_key=self.api_key)
\ No newline at end of file
+        return create_client(self.provider, self.api_key, **self.http_options)
\ No newline at end of file
@@ -1,6 +1,8 @@
-from groq import Groq
 from .basechathandler import BaseChatHandler
+from .clientpool import create_client
 
 class GroqHandler(BaseChatHandler):
+    provider = 'groq'
+
     def initialize_client(self):
-        return Groq(api_key=self.api_key)
\ No newline at end of file
+        return create_client(self.provider, self.api_key, **self.http_options)
\ No newline at end of file
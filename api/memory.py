@@ -1,7 +1,9 @@
-import tiktoken
 import logging
 import textwrap
-from .messagehandler import MessageHandler
+import metrics
+from array import array
+from .messagehandler import Message, MessageHandler, Role
+from .tokenizer import token_count, message_token_count
 from lib import load_template
 
 # Centralize default values
@@ -10,98 +12,189 @@ DEFAULT_TEMPERATURE = 0.4
 DEFAULT_TOP_P = 0.9
 DEFAULT_MAX_TOKENS = 16384
 
+# Memory state is serialized as a format version, the summary, one role code per message,
+# the message contents and the packed token counts. Contents are stored as a plain list of
+# strings, which pickle writes without any per-message overhead.
+STATE_VERSION = 2
+ROLES = tuple(Role)
+ROLE_CODES = {role: code for code, role in enumerate(ROLES)}
+_messages = MessageHandler()
+
 class Memory:
-    def __init__(self, ai_name, summary_prompt="summary_prompt", llm=None, model=DEFAULT_MODEL, temperature=DEFAULT_TEMPERATURE, top_p=DEFAULT_TOP_P, max_tokens=DEFAULT_MAX_TOKENS):
-        self._initialize(ai_name, summary_prompt, llm, model, temperature, top_p, max_tokens)
+    __slots__ = (
+        'log', 'ai_name', 'summary_prompt', 'llm', 'default_params', 'max_tokens', 'messages',
+        'max_history', 'high_watermark', 'low_watermark',
+        'message_history', 'token_counts', 'history_tokens', 'summary', 'summary_tokens'
+    )
+
+    def __init__(self, ai_name, summary_prompt="summary_prompt", llm=None, model=DEFAULT_MODEL, temperature=DEFAULT_TEMPERATURE, top_p=DEFAULT_TOP_P, max_tokens=DEFAULT_MAX_TOKENS, high_watermark=None, low_watermark=None):
+        self._initialize(ai_name, summary_prompt, llm, model, temperature, top_p, max_tokens, high_watermark, low_watermark)
         self.message_history = []
+        self.token_counts = array('I')
+        self.history_tokens = 0
         self.summary = None
+        self.summary_tokens = None
 
-    def reinit(self, ai_name, llm, model=DEFAULT_MODEL, temperature=DEFAULT_TEMPERATURE, top_p=DEFAULT_TOP_P, max_tokens=DEFAULT_MAX_TOKENS):
-        self._initialize(ai_name, llm, model, temperature, top_p, max_tokens)
+    def reinit(self, ai_name, summary_prompt="summary_prompt", llm=None, model=DEFAULT_MODEL, temperature=DEFAULT_TEMPERATURE, top_p=DEFAULT_TOP_P, max_tokens=DEFAULT_MAX_TOKENS, high_watermark=None, low_watermark=None):
+        self._initialize(ai_name, summary_prompt, llm, model, temperature, top_p, max_tokens, high_watermark, low_watermark)
 
-    def _initialize(self, ai_name, summary_prompt, llm, model, temperature, top_p, max_tokens):
+    def _initialize(self, ai_name, summary_prompt, llm, model, temperature, top_p, max_tokens, high_watermark, low_watermark):
         self.log = logging.getLogger(__name__)
         self.ai_name = ai_name
         self.summary_prompt = summary_prompt
-        self.client = llm
+        self.llm = llm
         self.default_params = {
             'model': model,
             'temperature': temperature,
             'top_p': top_p
         }
         self.max_tokens = max_tokens
-        self.messages = MessageHandler()
+        self.messages = _messages
         self.max_history = self.max_tokens // 2
+        self.high_watermark = high_watermark or self.max_history
+        self.low_watermark = min(low_watermark or self.high_watermark // 2, self.high_watermark)
 
     def __getstate__(self):
-        state = self.__dict__.copy()
-        del state['log']
-        del state['ai_name']
-        del state['client']
-        del state['default_params']
-        del state['max_tokens']
-        del state['messages']
-        del state['max_history']
-        return state
+        return (
+            STATE_VERSION,
+            self.summary,
+            bytes(ROLE_CODES[message.role] for message in self.message_history),
+            [message.content for message in self.message_history],
+            self.token_counts.tobytes(),
+            self.history_tokens
+        )
+
+    def __setstate__(self, state):
+        if isinstance(state, dict):
+            # Threads pickled before the compact format hold role/content dicts, and older
+            # ones no token counts, which are backfilled lazily on the next update.
+            self.message_history = [_messages.validate_single_message(message) for message in state.get('message_history', [])]
+            self.token_counts = array('I', state.get('token_counts', []))
+            self.history_tokens = state.get('history_tokens', 0)
+            self.summary = state.get('summary')
+            self.summary_tokens = None
+            return
+        version, self.summary, roles, contents, token_counts, self.history_tokens = state
+        self.summary_tokens = None
+        self.message_history = [Message(ROLES[code], content) for code, content in zip(roles, contents)]
+        self.token_counts = array('I')
+        self.token_counts.frombytes(token_counts)
+
+    def _sync_token_counts(self):
+        missing = self.message_history[len(self.token_counts):]
+        if missing:
+            counts = [self.count_message(message) for message in missing]
+            self.token_counts.extend(counts)
+            self.history_tokens += sum(counts)
+
+    def history_token_counts(self):
+        self._sync_token_counts()
+        return self.token_counts
+
+    def summary_token_count(self):
+        # Counted once per summary, the prompt budget needs it every turn.
+        if self.summary_tokens is None and self.summary:
+            self.summary_tokens = token_count(self.summary, self.default_params['model'])
+        return self.summary_tokens or 0
+
+    def count_message(self, message):
+        return message_token_count(message, self.default_params['model'])
 
     def update(self, messages, user):
         self.log.debug(f"Updating memory with messages: {messages}")
-        self.message_history.extend(messages)
-        messages_token_count = self.messages_token_counts(self.message_history)
+        with metrics.span("memory_update"):
+            self.message_history.extend(messages)
+            self._sync_token_counts()
+        messages_token_count = self.history_tokens
         self.log.info(f"Updated memory for user {user}, messages token count: {messages_token_count}")
-        if self.summary or messages_token_count > self.max_history:
-            self.update_summary(user)
+        return self.needs_summary()
 
-    def update_summary(self, user):
-        (user_id, user_name), = user.items()
-        self.log.debug(f"Updating summary with message history.")
-        new_lines = self.message_history[:2]
-        self.message_history = self.message_history[2:]
+    def needs_summary(self):
+        return self.history_tokens > self.high_watermark
+
+    def summary_batch(self):
+        """
+        Returns the oldest messages that have to be folded into the summary to bring the
+        history from above the high watermark down to the low watermark. They stay in
+        message_history until apply_summary commits the new summary.
+        """
+        self._sync_token_counts()
+        if not self.needs_summary():
+            return []
+        excess = self.history_tokens - self.low_watermark
+        folded_tokens = 0
+        count = 0
+        while count < len(self.token_counts) and folded_tokens < excess:
+            folded_tokens += self.token_counts[count]
+            count += 1
+        # Fold whole exchanges so the remaining history still starts with a user message.
+        if count % 2 and count < len(self.message_history):
+            count += 1
+        return self.message_history[:count]
+
+    async def request_summary(self, new_lines, user_name):
         self.log.debug(f"New lines: {new_lines}")
         prompt = self.construct_summary_prompt(new_lines, user_name)
         params = {'messages': prompt}
         params.update(self.default_params)
-        
+
         try:
-            response = self.client.chat.completions.create(**params)
+            response = await self.llm(**params)
             self.log.debug(f"Response: {response}")
-            self.summary = response.choices[0].message.content
-            self.log.debug(f"New summary: {self.summary}")
-            self.log.info(f"Updated summary for user {user_id}, summary token count: {self.token_count(self.summary)}")
+            return response.choices[0].message.content
         except Exception as e:
             self.log.error(f"Error getting response: {e}")
+            return None
+
+    def apply_summary(self, new_lines, summary):
+        """
+        Replaces the summary and drops the folded lines from the head of message_history.
+        Messages appended while the summary was being generated are kept.
+        """
+        self._sync_token_counts()
+        folded = len(new_lines)
+        del self.message_history[:folded]
+        self.history_tokens -= sum(self.token_counts[:folded])
+        del self.token_counts[:folded]
+        self.summary = summary
+        self.summary_tokens = None
+        self.log.debug(f"New summary: {self.summary}")
+
+    async def update_summary(self, user):
+        (user_id, user_name), = user.items()
+        self.log.debug(f"Updating summary with message history.")
+        new_lines = self.summary_batch()
+        summary = await self.request_summary(new_lines, user_name)
+        if summary is None:
+            return False
+        self.apply_summary(new_lines, summary)
+        self.log.info(f"Updated summary for user {user_id}, summary token count: {self.token_count(self.summary)}")
+        return True
 
     def construct_summary_prompt(self, new_lines, user_name):
         self.log.debug(f"Constructing summary prompt with new lines: {new_lines}")
         formatted_new_lines = ""
         for line in new_lines:
-            line['role'] = user_name if line['role'] == 'user' else self.ai_name
-            formatted_new_lines += f"{line['role']}: {line['content']}\n"
+            speaker = user_name if line.role is Role.USER else self.ai_name
+            formatted_new_lines += f"{speaker}: {line.content}\n"
         
         self.log.debug(f"Loading summary prompt template.")
         prompt_template = load_template(self.summary_prompt)
         self.log.debug(f"formatting summary prompt.")
         prompt = prompt_template.format(summary=self.summary, formatted_new_lines=formatted_new_lines, user_name=user_name, ai_name=self.ai_name)
         self.log.debug(f"Formatted summary prompt: {prompt}")
-        prompt_message = self.messages.create_message(prompt, role="system")
+        prompt_message = [message.to_dict() for message in self.messages.create_message(prompt, role="system", trusted=True)]
         self.log.debug(f"Constructed summary prompt: {prompt_message}")
         return prompt_message
 
     def messages_token_counts(self, messages):
-        self.log.debug("Aggregating text from messages to calculate tokens.")
-        text = "".join(f"{message['role']}: {message['content']}\n" for message in messages)
-        self.log.debug(f"Aggregated text: {text}")
-        total_tokens = self.token_count(text)
+        self.log.debug("Calculating tokens for messages.")
+        total_tokens = sum(self.count_message(message) for message in messages)
         self.log.debug(f"Total token count: {total_tokens}")
         return total_tokens
 
     def token_count(self, text):
         self.log.debug(f"Counting tokens for text: {text}")
-        try:
-            encoding = tiktoken.get_encoding("cl100k_base")
-            num_tokens = len(encoding.encode(text))
-        except Exception as e:
-            self.log.error(f"Failed to count tokens: {e}")
-            num_tokens = 0
+        num_tokens = token_count(text, self.default_params['model'])
         self.log.debug(f"Token count: {num_tokens}")
-        return num_tokens
\ No newline at end of file
+        return num_tokens
@@ -1,28 +1,54 @@
 import logging
-    
+from enum import Enum
+
+class Role(str, Enum):
+    SYSTEM = "system"
+    USER = "user"
+    ASSISTANT = "assistant"
+
+class Message:
+    """
+    A single chat message. History is kept as these slotted records and only converted
+    to the role/content dicts of the provider APIs when a prompt is sent.
+    """
+    __slots__ = ('role', 'content')
+
+    def __init__(self, role, content):
+        self.role = role
+        self.content = content
+
+    def to_dict(self):
+        return {'role': self.role.value, 'content': self.content}
+
+    def __eq__(self, other):
+        return isinstance(other, Message) and self.role is other.role and self.content == other.content
+
+    def __repr__(self):
+        return f"Message({self.role.value!r}, {self.content!r})"
+
 class MessageHandler:
     def __init__(self):
         self.log = logging.getLogger(__name__)
         self.response_type = list
         self.required_keys = ["role", "content"]
-        self.valid_roles = ["system", "user", "assistant"]
-        self.role_type = str,
+        self.valid_roles = [role.value for role in Role]
+        self.role_type = str
         self.content_type = str
 
-    def create_message(self, input_message, role=None):
+    def create_message(self, input_message, role=None, trusted=False):
+        """
+        Returns the input as a list of Messages. Accepts a string with a role, or a list of
+        Messages or role/content dicts. trusted skips validation for strings built internally.
+        """
+        if trusted:
+            return [Message(Role(role), input_message)]
         self.log.debug(f"Creating message with input: {input_message}")
         if isinstance(input_message, self.response_type):
-            message = input_message
+            return [self.validate_single_message(message) for message in input_message]
         elif role and isinstance(input_message, self.content_type):
-            role_key = self.required_keys[0]
-            content_key = self.required_keys[1]
-            message = [{role_key: role, content_key: input_message}]
-
+            return [self.validate_single_message({'role': role, 'content': input_message})]
         else:
             raise ValueError("Invalid input format. Provide a list of message dicts, a single dict, or a string with a role.")
-        
-        self.validate_messages(message)
-        return message
 
     def validate_messages(self, messages):
         if not isinstance(messages, self.response_type):
@@ -31,13 +57,21 @@ class MessageHandler:
             self.validate_single_message(message)
 
     def validate_single_message(self, message):
+        """
+        Validates a message and returns it as a Message.
+        """
+        if type(message) is Message:
+            if not isinstance(message.content, self.content_type):
+                raise TypeError(f"Content must be a {self.content_type.__name__}")
+            return message
         if not isinstance(message, dict):
             raise TypeError("Message must be a dictionary.")
         if not all(key in message for key in self.required_keys):
             raise ValueError(f"Message must contain all of {self.required_keys}.")
+        if not isinstance(message['role'], self.role_type):
+            raise TypeError(f"Role must be a {self.role_type.__name__}.")
         if message['role'] not in self.valid_roles:
             raise ValueError(f"Role must be one of {self.valid_roles}")
         if not isinstance(message['content'], self.content_type):
             raise TypeError(f"Content must be a {self.content_type.__name__}")
-        if not isinstance(message['role'], self.role_type):
-            raise TypeError(f"Role must be a {self.role_type.__name__}.")
\ No newline at end of file
+        return Message(Role(message['role']), message['content'])
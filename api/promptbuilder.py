@@ -1,47 +1,152 @@
 from lib import load_character_sheet, load_template
+from .messagehandler import Role
 import logging
+import metrics
+from collections import OrderedDict
 
 class PromptBuilder:
-    def __init__(self, ai_name, template, formatter):
+    def __init__(self, ai_name, template, formatter, layout="default", budget=None, cache_size=1024):
+        if layout not in ("default", "cache"):
+            raise ValueError(f"Unknown prompt layout: {layout}")
         self.log = logging.getLogger(__name__)
         self.ai_name = ai_name
         self.template = template
         self.formatter = formatter
+        self.layout = layout
+        self.budget = budget
+        self.last_budget_report = None
+        self.cache_size = cache_size
+        self.static_messages = OrderedDict()
 
-    def build_prompt(self, user, user_input, memory):
-        prompt = []
-        self.log.debug("Building prompt...")
-        system_message = self.construct_system_message(user, memory.summary)
-        system_message = self.formatter.create_message(system_message, role="system")
+    def build_prompt(self, user, user_input, memory, recalled=None):
+        with metrics.span("prompt_build"):
+            prompt = []
+            self.log.debug("Building prompt...")
+            # The cache layout keeps the system message static and moves the summary after the
+            # history, so consecutive prompts share a byte-identical prefix for provider prompt caching.
+            cache_layout = self.layout == "cache"
+            summary = memory.summary
+            history = memory.message_history
+            user_input = self.formatter.create_message(user_input, role="user")
+            (user_id, user_name), = user.items()
+            static_message = self.render_static_message(user_id, user_name)
 
-        prompt.extend(system_message)
+            if self.budget is not None:
+                with metrics.span("context_budget"):
+                    summary, recalled, history = self.fit_to_budget(user, user_input, memory, recalled, self.static_message_tokens(user_id))
 
-        if memory.message_history:
-            prompt.extend(memory.message_history)
-            
-        user_input = self.formatter.create_message(user_input, role="user")
-        prompt.extend(user_input)
+            if cache_layout:
+                system_message = self.construct_system_message(user, None, static_message=static_message)
+            else:
+                system_message = self.construct_system_message(user, summary, recalled, static_message)
+            system_message = self.formatter.create_message(system_message, role="system", trusted=True)
 
-        return prompt
-    
-    def construct_system_message(self, user, memory_summary):
+            prompt.extend(system_message)
+
+            if history:
+                prompt.extend(history)
+
+            context = self.construct_context(user, summary, recalled) if cache_layout else None
+            if context:
+                prompt.extend(self.formatter.create_message(context, role="system", trusted=True))
+
+            prompt.extend(user_input)
+
+            # Messages become provider API dicts only here.
+            return [message.to_dict() for message in prompt]
+
+    def fit_to_budget(self, user, user_input, memory, recalled, static_tokens):
+        # Recalled messages are costed and dropped together with the summary.
+        summary_tokens = self.context_tokens(user, memory, recalled)
+        summary_kept, start, report = self.budget.fit(
+            static_tokens,
+            summary_tokens,
+            memory.message_history,
+            memory.history_token_counts(),
+            user_input
+        )
+        self.last_budget_report = report
+        if report['trimmed_messages'] or report['summary_dropped']:
+            self.log.info(f"Trimmed {report['trimmed_messages']} history messages ({report['trimmed_tokens']} tokens, summary dropped: {report['summary_dropped']}) to fit {report['limit']} prompt tokens")
+        if not summary_kept:
+            summary, recalled = None, None
+        else:
+            summary = memory.summary
+        history = memory.message_history[start:] if start else memory.message_history
+        return summary, recalled, history
+
+    def context_tokens(self, user, memory, recalled=None):
+        """
+        Returns the token count of the context construct_context builds, from the summary's
+        cached count and the recalled messages, or None without a context. Counting the
+        parts separately can be off by a few tokens, which the budget's safety margin covers.
+        """
+        if not memory.summary and not recalled:
+            return None
+        tokens = memory.summary_token_count() + self.budget.count_text("Summary: ") if memory.summary else 0
+        if recalled:
+            (user_id, user_name), = user.items()
+            lines = [f"{user_name if message['role'] == 'user' else self.ai_name}: {message['content']}" for message in recalled]
+            tokens += self.budget.count_text("\nRelevant earlier conversation:\n" + "\n".join(lines))
+        return tokens
+
+    def construct_context(self, user, memory_summary, recalled=None):
+        parts = []
+        if memory_summary:
+            parts.append(f"Summary: {memory_summary}")
+        if recalled:
+            (user_id, user_name), = user.items()
+            lines = [f"{user_name if message['role'] == 'user' else self.ai_name}: {message['content']}" for message in recalled]
+            parts.append("Relevant earlier conversation:\n" + "\n".join(lines))
+        return "\n".join(parts) or None
+
+    def construct_system_message(self, user, memory_summary, recalled=None, static_message=None):
         self.log.debug("Constructing system message...")
         self.log.debug(user)
         (user_id, user_name), = user.items()
         self.log.debug(f"User ID: {user_id}, User Name: {user_name}")
         self.log.debug(f"AI Name: {self.ai_name}, Template: {self.template}")
-        template = load_template(self.template)
-        ai_sheet = load_character_sheet(self.ai_name)
-        user_sheet = load_character_sheet(self.ai_name, user_id)
-
-        template = f"{template}\n{ai_sheet}\n{user_sheet}"
-
-        self.log.debug(f"formatting template...")
-        system_message = template.format(assistant=self.ai_name, user=user_name)
+        system_message = static_message if static_message is not None else self.render_static_message(user_id, user_name)
         self.log.debug(f"{system_message}")
 
-        if memory_summary:
-            system_message += f"\nSummary: {memory_summary}"
+        context = self.construct_context(user, memory_summary, recalled)
+        if context:
+            system_message += f"\n{context}"
 
         self.log.debug('returning system message...')
+        return system_message
+
+    def static_message_tokens(self, user_id):
+        """
+        Returns the token count of the user's last rendered static message, counted once per render.
+        """
+        entry = self.static_messages[user_id]
+        if entry[3] is None:
+            entry[3] = self.budget.count_text(f"{Role.SYSTEM.value}: {entry[2]}\n")
+        return entry[3]
+
+    def render_static_message(self, user_id, user_name):
+        """
+        Returns the formatted template and character sheets for the user. The rendered text
+        is reused until one of the source files changes on disk or the user's name changes,
+        for the cache_size most recently seen users.
+        """
+        with metrics.span("template_load"):
+            sources = (
+                load_template(self.template),
+                load_character_sheet(self.ai_name),
+                load_character_sheet(self.ai_name, user_id)
+            )
+        cached = self.static_messages.get(user_id)
+        if cached is not None and cached[0] == user_name and all(a is b for a, b in zip(cached[1], sources)):
+            self.static_messages.move_to_end(user_id)
+            return cached[2]
+
+        template = "\n".join(sources)
+        self.log.debug(f"formatting template...")
+        system_message = template.format(assistant=self.ai_name, user=user_name)
+        self.static_messages[user_id] = [user_name, sources, system_message, None]
+        self.static_messages.move_to_end(user_id)
+        while len(self.static_messages) > self.cache_size:
+            self.static_messages.popitem(last=False)
         return system_message
\ No newline at end of file
@@ -0,0 +1,122 @@
+import asyncio
+import logging
+import re
+import time
+
+_limiters = {}
+_duration_pattern = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_duration_units = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+
+def parse_duration(value):
+    """
+    Parses rate-limit reset durations such as "20ms", "1.5s" or "6m0s" into seconds.
+    """
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = _duration_pattern.findall(value)
+    if not parts:
+        return None
+    return sum(float(amount) * _duration_units[unit] for amount, unit in parts)
+
+def retry_after(headers):
+    """
+    Returns the delay requested by a Retry-After style header, in seconds, or None.
+    """
+    if not headers:
+        return None
+    milliseconds = headers.get('retry-after-ms')
+    if milliseconds is not None:
+        try:
+            return float(milliseconds) / 1000
+        except ValueError:
+            pass
+    return parse_duration(headers.get('retry-after'))
+
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount, now):
+        self.refill(now)
+        amount = min(amount, self.capacity)
+        return 0.0 if self.level >= amount else (amount - self.level) / self.rate
+
+    def consume(self, amount):
+        self.level -= min(amount, self.capacity)
+
+    def limit_to(self, remaining, now):
+        self.refill(now)
+        self.level = min(self.level, float(remaining))
+
+class RateLimiter:
+    """
+    Keeps requests to a provider within its requests-per-minute and tokens-per-minute
+    budgets. Callers wait in acquire() until both budgets allow the request, and the
+    budgets are corrected from the provider's rate-limit headers and Retry-After delays.
+    """
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None):
+        self.log = logging.getLogger(__name__)
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.blocked_until = 0.0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, tokens=0):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                wait = self.blocked_until - now
+                if self.requests:
+                    wait = max(wait, self.requests.wait_time(1, now))
+                if self.tokens:
+                    wait = max(wait, self.tokens.wait_time(tokens, now))
+                if wait <= 0:
+                    break
+                self.log.debug(f"Rate limit budget exhausted, waiting {wait:.2f}s")
+                await asyncio.sleep(wait)
+            if self.requests:
+                self.requests.consume(1)
+            if self.tokens:
+                self.tokens.consume(tokens)
+
+    def penalize(self, delay):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + delay)
+
+    def update_from_headers(self, headers):
+        if not headers:
+            return
+        now = time.monotonic()
+        for bucket, kind in ((self.requests, 'requests'), (self.tokens, 'tokens')):
+            remaining = headers.get(f'x-ratelimit-remaining-{kind}')
+            if remaining is None:
+                continue
+            try:
+                remaining = float(remaining)
+            except ValueError:
+                continue
+            if bucket:
+                bucket.limit_to(remaining, now)
+            if remaining <= 0:
+                reset = parse_duration(headers.get(f'x-ratelimit-reset-{kind}'))
+                if reset:
+                    self.penalize(reset)
+
+def get_rate_limiter(key, requests_per_minute=None, tokens_per_minute=None):
+    """
+    Returns the limiter shared by every handler using the same provider and api key.
+    """
+    limiter = _limiters.get(key)
+    if limiter is None:
+        limiter = _limiters[key] = RateLimiter(requests_per_minute, tokens_per_minute)
+    return limiter
@@ -0,0 +1,54 @@
+import hashlib
+import json
+import logging
+import metrics
+import time
+from collections import OrderedDict
+
+def prompt_key(params):
+    """
+    Returns a hash of completion parameters, the prompt together with the model and
+    sampling settings it is sent with.
+    """
+    return hashlib.sha256(json.dumps(params, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+
+class ResponseCache:
+    """
+    LRU cache of replies holding at most max_size entries, each dropped ttl seconds after
+    it was stored (never with ttl=None). Hits and misses are counted per cache name.
+    """
+    def __init__(self, name, max_size=1024, ttl=None):
+        self.log = logging.getLogger(__name__)
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is not None and self.ttl is not None and time.monotonic() - entry[0] > self.ttl:
+            del self.entries[key]
+            entry = None
+        if entry is None:
+            self.misses += 1
+            metrics.increment("cache_misses_total", cache=self.name)
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        metrics.increment("cache_hits_total", cache=self.name)
+        return entry[1]
+
+    def put(self, key, value):
+        self.entries[key] = (time.monotonic(), value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self):
+        return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hit_rate()}
@@ -0,0 +1,159 @@
+import asyncio
+import time
+from collections import deque
+from .basechathandler import BaseChatHandler
+from .clientpool import create_client, provider_semaphore
+from .contextbudget import context_window
+from .ratelimiter import get_rate_limiter
+
+class Backend:
+    def __init__(self, name, provider, client, model, memory_model, semaphore, rate_limiter, max_retries, window=50):
+        self.name = name
+        self.provider = provider
+        self.client = client
+        self.model = model
+        self.memory_model = memory_model
+        self.semaphore = semaphore
+        self.rate_limiter = rate_limiter
+        self.max_retries = max_retries
+        self.latencies = deque(maxlen=window)
+        self.outcomes = deque(maxlen=window)
+        self.unhealthy_until = 0.0
+
+    def record(self, latency, ok, cooldown):
+        self.outcomes.append(ok)
+        if ok:
+            self.latencies.append(latency)
+        elif len(self.outcomes) >= 3 and (self.error_rate() >= 0.5 or not any(list(self.outcomes)[-3:])):
+            self.unhealthy_until = time.monotonic() + cooldown
+
+    def record_cancelled(self, elapsed):
+        # A request abandoned after losing a hedge took at least this long.
+        self.latencies.append(elapsed)
+
+    def error_rate(self):
+        if not self.outcomes:
+            return 0.0
+        return self.outcomes.count(False) / len(self.outcomes)
+
+    def latency_percentile(self, percentile):
+        if not self.latencies:
+            return None
+        latencies = sorted(self.latencies)
+        return latencies[min(int(len(latencies) * percentile), len(latencies) - 1)]
+
+    def healthy(self):
+        return time.monotonic() >= self.unhealthy_until
+
+    def rank(self):
+        # Backends without samples yet rank first so their latency gets measured.
+        return (not self.healthy(), (self.latency_percentile(0.5) or 0.0) / (1 - min(self.error_rate(), 0.9)))
+
+class RouterHandler(BaseChatHandler):
+    """
+    Routes completions across several provider backends, each with its own key and
+    model. Requests go to the healthy backend with the lowest median latency. With
+    hedge_requests enabled, a duplicate request is sent to the next backend once the
+    first one runs past its hedge_percentile latency, and the first answer wins.
+    Memory and summaries belong to the router, so they are shared by all backends.
+    """
+    provider = 'router'
+
+    def __init__(self, ai_name, template, backends, api_key=None, hedge_requests=False, hedge_percentile=0.95, hedge_min_delay=1.0, backend_cooldown=30.0, **kwargs):
+        self.backend_configs = backends
+        self.hedge_requests = hedge_requests
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_delay = hedge_min_delay
+        self.backend_cooldown = backend_cooldown
+        self.backend_options = kwargs
+        kwargs.setdefault('model', backends[0]['model'])
+        # Prompts have to fit whichever backend ends up answering them.
+        kwargs.setdefault('context_window', min(context_window(backend['model']) for backend in backends))
+        super().__init__(api_key, ai_name, template, **kwargs)
+
+    def initialize_client(self):
+        self.backends = []
+        for index, config in enumerate(self.backend_configs):
+            provider = config['provider']
+            self.backends.append(Backend(
+                name=config.get('name', f"{provider}-{index}"),
+                provider=provider,
+                client=create_client(provider, config['api_key'], **self.http_options),
+                model=config['model'],
+                memory_model=config.get('memory_model'),
+                semaphore=provider_semaphore(provider, config.get('max_concurrent_requests', self.backend_options.get('max_concurrent_requests', 16))),
+                rate_limiter=get_rate_limiter((provider, config['api_key']), config.get('requests_per_minute'), config.get('tokens_per_minute')),
+                max_retries=config.get('max_retries', 1)
+            ))
+        return None
+
+    def provider_clients(self):
+        return list({id(backend.client): backend.client for backend in self.backends}.values())
+
+    def ranked_backends(self):
+        return sorted(self.backends, key=Backend.rank)
+
+    def hedge_delay(self, backend):
+        return max(backend.latency_percentile(self.hedge_percentile) or 0.0, self.hedge_min_delay)
+
+    async def create_completion(self, prompt_tokens=None, **params):
+        return await self.route(params, self.hedge_requests, prompt_tokens)
+
+    async def send_request(self, params, prompt_tokens=None):
+        return await self.route(params, False, prompt_tokens)
+
+    async def call_backend(self, backend, params, prompt_tokens=None):
+        model = backend.model if params['model'] == self.model else backend.memory_model or backend.model
+        started = time.monotonic()
+        try:
+            async with backend.semaphore:
+                response = await self.request_completion(backend.client, backend.rate_limiter, dict(params, model=model), backend.max_retries, prompt_tokens)
+        except asyncio.CancelledError:
+            backend.record_cancelled(time.monotonic() - started)
+            raise
+        except Exception:
+            backend.record(time.monotonic() - started, False, self.backend_cooldown)
+            raise
+        backend.record(time.monotonic() - started, True, self.backend_cooldown)
+        self.log.debug(f"Backend {backend.name} answered in {time.monotonic() - started:.3f}s")
+        return response
+
+    async def route(self, params, hedge, prompt_tokens=None):
+        """
+        Sends the request to the best ranked backend, failing over to the next one on
+        errors and, when hedging, racing the next one after the hedge delay.
+        """
+        candidates = iter(self.ranked_backends())
+        pending = {}
+        errors = []
+
+        def launch():
+            backend = next(candidates, None)
+            if backend is not None:
+                pending[asyncio.create_task(self.call_backend(backend, params, prompt_tokens))] = backend
+            return backend
+
+        primary = launch()
+        hedged = not hedge
+        try:
+            while pending:
+                timeout = None if hedged else self.hedge_delay(primary)
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    hedged = True
+                    backend = launch()
+                    if backend is not None:
+                        self.log.info(f"Hedging request to {backend.name} after {timeout:.2f}s without an answer from {primary.name}")
+                    continue
+                for task in done:
+                    backend = pending.pop(task)
+                    if task.exception() is None:
+                        return task.result()
+                    self.log.warning(f"Backend {backend.name} failed: {task.exception()}")
+                    errors.append(task.exception())
+                if not pending:
+                    launch()
+        finally:
+            for task in pending:
+                task.cancel()
+        raise errors[-1]
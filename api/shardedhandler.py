@@ -0,0 +1,304 @@
+import asyncio
+import importlib
+import itertools
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import zlib
+import metrics
+from lib import setup_logging
+from .clientpool import close_clients
+
+# Provider limits are per process, so they are split between the workers.
+SPLIT_LIMITS = ('max_concurrent_requests', 'requests_per_minute', 'tokens_per_minute')
+# Seconds between metrics sent by the workers to the parent process.
+METRICS_INTERVAL = 5.0
+# Seconds between checks for worker processes that have exited.
+WORKER_CHECK_INTERVAL = 1.0
+
+def shard_for(user_id, shards):
+    return zlib.crc32(str(user_id).encode()) % shards
+
+class ShardedHandler:
+    """
+    Runs the configured handler in worker processes and forwards each request to the
+    worker that owns the user, picked by a stable hash of the user id. Workers keep their
+    users' memory and persistence, and handle one request per user at a time, so per-user
+    ordering is kept while prompt building, token counting and serialization use all cores.
+
+    A worker that exits fails its pending requests and is started again, up to
+    max_restarts times per minute, after which requests for its users are rejected.
+    """
+    def __init__(self, handler_module, handler_class, handler_kwargs, workers=None, start_timeout=120.0, log_level=None, call_timeout=600.0, max_restarts=3):
+        self.log = logging.getLogger(__name__)
+        self.workers = workers or os.cpu_count() or 1
+        self.stream = handler_kwargs.get('stream', False)
+        self.call_timeout = call_timeout
+        self.max_restarts = max_restarts
+        self.request_ids = itertools.count()
+        self.pending = {}
+        self.loop = None
+        self.closing = False
+        self.restarts = [[] for _ in range(self.workers)]
+        self.failed = set()
+        # Run one-time setup such as migrations here, so the workers do not race on it.
+        HandlerClass = getattr(importlib.import_module(handler_module), handler_class)
+        HandlerClass.prepare_shared_state(**handler_kwargs)
+        self.context = multiprocessing.get_context("spawn")
+        self.results = self.context.Queue()
+        self.worker_args = (handler_module, handler_class, self.worker_kwargs(handler_kwargs))
+        self.log_level = log_level if log_level is not None else logging.getLogger().getEffectiveLevel()
+        self.requests = [None] * self.workers
+        self.processes = [None] * self.workers
+        for shard in range(self.workers):
+            self.spawn(shard)
+        self.wait_ready(start_timeout)
+        self.reader = threading.Thread(target=self.read_results, name="shard-results", daemon=True)
+        self.reader.start()
+        self.log.info(f"Started {self.workers} {handler_class} workers")
+
+    def worker_kwargs(self, handler_kwargs):
+        kwargs = dict(handler_kwargs)
+        for key in SPLIT_LIMITS:
+            if kwargs.get(key):
+                kwargs[key] = max(1, kwargs[key] // self.workers)
+        return kwargs
+
+    def spawn(self, shard):
+        requests = self.context.Queue()
+        process = self.context.Process(
+            target=run_worker,
+            args=(shard, *self.worker_args, requests, self.results, self.log_level),
+            name=f"shard-{shard}",
+            daemon=True
+        )
+        process.start()
+        self.requests[shard] = requests
+        self.processes[shard] = process
+
+    def wait_ready(self, timeout):
+        deadline = time.monotonic() + timeout
+        ready = 0
+        while ready < self.workers:
+            try:
+                _, kind, payload = self.results.get(timeout=1.0)
+            except queue.Empty:
+                exited = [process.name for process in self.processes if process.exitcode is not None]
+                if exited or time.monotonic() > deadline:
+                    self.terminate()
+                    reason = f"{', '.join(exited)} exited" if exited else "timed out"
+                    raise RuntimeError(f"Handler workers failed to start ({reason}), {ready} of {self.workers} ready")
+                continue
+            if kind == 'error':
+                self.terminate()
+                raise RuntimeError(f"Handler worker failed to start: {payload}")
+            if kind == 'ready':
+                ready += 1
+
+    def read_results(self):
+        last_check = time.monotonic()
+        while True:
+            # Workers are checked on a fixed schedule, a busy queue must not hide a dead one.
+            if time.monotonic() - last_check >= WORKER_CHECK_INTERVAL:
+                self.check_workers()
+                last_check = time.monotonic()
+            try:
+                message = self.results.get(timeout=WORKER_CHECK_INTERVAL)
+            except queue.Empty:
+                continue
+            if message is None:
+                return
+            request_id, kind, payload = message
+            if kind == 'metrics':
+                if self.loop is not None:
+                    self.loop.call_soon_threadsafe(metrics.registry.merge, *payload)
+                continue
+            if request_id is None:
+                # Startup messages of restarted workers.
+                if kind == 'error':
+                    self.log.error(f"Handler worker failed to restart: {payload}")
+                else:
+                    self.log.info(f"Handler worker {payload} restarted")
+                continue
+            entry = self.pending.get(request_id)
+            if entry is None:
+                continue
+            loop, waiter, _ = entry
+            loop.call_soon_threadsafe(self.deliver, request_id, waiter, kind, payload)
+
+    def check_workers(self):
+        if self.closing:
+            return
+        for shard, process in enumerate(self.processes):
+            if shard in self.failed or process.exitcode is None:
+                continue
+            self.log.error(f"Handler worker {process.name} exited with code {process.exitcode}")
+            now = time.monotonic()
+            self.restarts[shard] = [started for started in self.restarts[shard] if now - started < 60.0]
+            if len(self.restarts[shard]) < self.max_restarts:
+                self.restarts[shard].append(now)
+                self.spawn(shard)
+            else:
+                self.failed.add(shard)
+                self.log.error(f"Handler worker {process.name} keeps exiting, rejecting requests for its users")
+            # Requests sent before the restart are lost with the worker.
+            for request_id, (loop, waiter, request_shard) in list(self.pending.items()):
+                if request_shard == shard:
+                    loop.call_soon_threadsafe(self.deliver, request_id, waiter, 'error', f"Handler worker {process.name} exited")
+
+    def deliver(self, request_id, waiter, kind, payload):
+        if isinstance(waiter, asyncio.Queue):
+            waiter.put_nowait((kind, payload))
+            return
+        self.pending.pop(request_id, None)
+        if waiter.done():
+            return
+        if kind == 'error':
+            waiter.set_exception(RuntimeError(payload))
+        else:
+            waiter.set_result(payload)
+
+    def submit(self, user_id, method, args, waiter):
+        shard = shard_for(user_id, self.workers)
+        if shard in self.failed:
+            raise RuntimeError(f"Handler worker {shard} is not running")
+        request_id = next(self.request_ids)
+        self.loop = asyncio.get_running_loop()
+        self.pending[request_id] = (self.loop, waiter, shard)
+        # The registry is enabled after the workers start, so its state travels with each request.
+        self.requests[shard].put((request_id, user_id, method, args, metrics.registry.enabled))
+        return request_id
+
+    async def call(self, user_id, method, *args):
+        future = asyncio.get_running_loop().create_future()
+        request_id = self.submit(user_id, method, args, future)
+        try:
+            return await asyncio.wait_for(future, self.call_timeout)
+        except asyncio.TimeoutError:
+            raise RuntimeError(f"Handler worker did not answer {method} within {self.call_timeout}s")
+        finally:
+            self.pending.pop(request_id, None)
+
+    async def get_ai_response(self, user_input, user):
+        (user_id, user_name), = user.items()
+        return await self.call(user_id, 'get_ai_response', user_input, user)
+
+    async def stream_ai_response(self, user_input, user):
+        (user_id, user_name), = user.items()
+        deltas = asyncio.Queue()
+        request_id = self.submit(user_id, 'stream_ai_response', (user_input, user), deltas)
+        try:
+            while True:
+                try:
+                    kind, payload = await asyncio.wait_for(deltas.get(), self.call_timeout)
+                except asyncio.TimeoutError:
+                    raise RuntimeError(f"Handler worker did not answer stream_ai_response within {self.call_timeout}s")
+                if kind == 'delta':
+                    yield payload
+                elif kind == 'error':
+                    raise RuntimeError(payload)
+                else:
+                    return
+        finally:
+            self.pending.pop(request_id, None)
+
+    async def warmup(self):
+        # Workers warm up their own handlers once they are ready.
+        return {}
+
+    async def reset_thread(self, user_id):
+        await self.call(user_id, 'reset_thread', user_id)
+
+    async def get_training_example(self, user_id, user_name, response):
+        return await self.call(user_id, 'get_training_example', user_id, user_name, response)
+
+    async def close(self):
+        self.closing = True
+        for requests in self.requests:
+            requests.put(None)
+        await asyncio.get_running_loop().run_in_executor(None, self.join)
+        self.results.put(None)
+
+    def join(self, timeout=60.0):
+        for process in self.processes:
+            process.join(timeout)
+        self.terminate()
+
+    def terminate(self):
+        for process in self.processes:
+            if process.is_alive():
+                self.log.warning(f"Terminating handler worker {process.name}")
+                process.terminate()
+
+def run_worker(shard, handler_module, handler_class, handler_kwargs, requests, results, log_level):
+    setup_logging()
+    logging.getLogger().setLevel(log_level)
+    asyncio.run(serve_shard(shard, handler_module, handler_class, handler_kwargs, requests, results))
+
+async def serve_shard(shard, handler_module, handler_class, handler_kwargs, requests, results):
+    log = logging.getLogger(__name__)
+    try:
+        HandlerClass = getattr(importlib.import_module(handler_module), handler_class)
+        handler = HandlerClass(**handler_kwargs)
+    except Exception as e:
+        results.put((None, 'error', f"{type(e).__name__}: {e}"))
+        return
+    results.put((None, 'ready', shard))
+    log.info(f"Handler worker {shard} ready")
+    warmup = asyncio.create_task(handler.warmup())
+    # Stage metrics are recorded here when the parent has them enabled, and sent to it to be served.
+    sender = asyncio.create_task(send_metrics(results))
+
+    loop = asyncio.get_running_loop()
+    locks = {}
+    tasks = set()
+    while True:
+        message = await loop.run_in_executor(None, requests.get)
+        if message is None:
+            break
+        task = asyncio.create_task(handle_request(handler, locks, message, results))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    await asyncio.gather(warmup, *tasks, return_exceptions=True)
+    await handler.close()
+    await close_clients()
+    sender.cancel()
+    await asyncio.gather(sender, return_exceptions=True)
+    flush_metrics(results)
+    log.info(f"Handler worker {shard} stopped")
+
+async def send_metrics(results):
+    while True:
+        await asyncio.sleep(METRICS_INTERVAL)
+        flush_metrics(results)
+
+def flush_metrics(results):
+    counters, histograms = metrics.registry.drain()
+    if counters or histograms:
+        results.put((None, 'metrics', (counters, histograms)))
+
+async def handle_request(handler, locks, message, results):
+    request_id, user_id, method, args, metrics_enabled = message
+    metrics.registry.enabled = metrics_enabled
+    # Locks are counted by their users and dropped once free, so the dict does not grow with every user.
+    entry = locks.get(user_id)
+    if entry is None:
+        entry = locks[user_id] = [asyncio.Lock(), 0]
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            if method == 'stream_ai_response':
+                async for delta in handler.stream_ai_response(*args):
+                    results.put((request_id, 'delta', delta))
+                results.put((request_id, 'done', None))
+            else:
+                results.put((request_id, 'result', await getattr(handler, method)(*args)))
+    except Exception as e:
+        results.put((request_id, 'error', str(e)))
+    finally:
+        entry[1] -= 1
+        if not entry[1]:
+            del locks[user_id]
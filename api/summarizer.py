@@ -0,0 +1,80 @@
+import asyncio
+import logging
+import metrics
+
+class Summarizer:
+    def __init__(self, max_concurrency=2, on_complete=None):
+        self.log = logging.getLogger(__name__)
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.on_complete = on_complete
+        self.pending = {}
+        self.tasks = {}
+        self.generations = {}
+        self.turns = 0
+        self.calls = 0
+
+    def record_turn(self):
+        self.turns += 1
+
+    def calls_per_turn(self):
+        return self.calls / self.turns if self.turns else 0.0
+
+    def schedule(self, user, memory):
+        """
+        Queues a summary update for the user. Turns queued while the user's previous
+        summary is pending or running are coalesced into a single summary call.
+        """
+        (user_id, user_name), = user.items()
+        self.pending[user_id] = (user, memory)
+        if user_id not in self.tasks:
+            self.tasks[user_id] = asyncio.create_task(self._run(user_id))
+
+    async def _run(self, user_id):
+        try:
+            while user_id in self.pending:
+                async with self.semaphore:
+                    user, memory = self.pending.pop(user_id)
+                    if not memory.needs_summary():
+                        continue
+                    generation = self.generations.get(user_id, 0)
+                    folded = await self.summarize(user, memory)
+                if generation != self.generations.get(user_id, 0):
+                    self.log.debug(f"Thread for user {user_id} was reset during summary update, discarding it")
+                    continue
+                if folded and self.on_complete:
+                    await self.on_complete(user_id, memory, folded)
+        except Exception as e:
+            self.log.error(f"Error updating summary for user {user_id}: {e}")
+        finally:
+            del self.tasks[user_id]
+            self.generations.pop(user_id, None)
+
+    def discard(self, user_id):
+        """
+        Drops the user's queued summary update, and the result of a running one.
+        """
+        self.pending.pop(user_id, None)
+        if user_id in self.tasks:
+            self.generations[user_id] = self.generations.get(user_id, 0) + 1
+
+    async def summarize(self, user, memory):
+        (user_id, user_name), = user.items()
+        new_lines = memory.summary_batch()
+        if not new_lines:
+            return None
+        self.calls += 1
+        metrics.increment("summary_calls_total")
+        with metrics.span("summary"):
+            summary = await memory.request_summary(new_lines, user_name)
+        if summary is None:
+            metrics.increment("summary_errors_total")
+            return None
+        metrics.increment("summary_folded_messages_total", len(new_lines))
+        memory.apply_summary(new_lines, summary)
+        self.log.info(f"Updated summary for user {user_id}, folded {len(new_lines)} messages, summary token count: {memory.token_count(summary)}")
+        self.log.info(f"Summary calls: {self.calls} over {self.turns} turns ({self.calls_per_turn():.3f} per turn)")
+        return new_lines
+
+    async def drain(self):
+        while self.tasks:
+            await asyncio.gather(*self.tasks.values(), return_exceptions=True)
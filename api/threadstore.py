@@ -0,0 +1,157 @@
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+class ThreadStore:
+    """
+    SQLite-backed store for per-user Memory objects. Users are loaded lazily on first
+    access and the most recently used ones are kept in an in-memory LRU. Each save
+    writes a single user's row in its own transaction. Writes should go through
+    `executor`, a single worker thread, so they reach the database in order.
+    """
+    def __init__(self, db_path, cache_size=1024, on_load=None):
+        self.log = logging.getLogger(__name__)
+        self.db_path = db_path
+        self.cache_size = cache_size
+        self.on_load = on_load
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="threadstore")
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self.connection = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        with self.lock:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS user_threads ("
+                "user_id TEXT PRIMARY KEY, "
+                "memory BLOB NOT NULL, "
+                "updated_at REAL NOT NULL)"
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS corrupt_threads ("
+                "user_id TEXT NOT NULL, "
+                "memory BLOB NOT NULL, "
+                "error TEXT NOT NULL, "
+                "moved_at REAL NOT NULL)"
+            )
+
+    def get(self, user_id, default=None):
+        memory = self.peek(user_id)
+        if memory is not None:
+            return memory
+        memory = self.load(user_id)
+        if memory is None:
+            return default
+        self.put(user_id, memory)
+        return memory
+
+    def peek(self, user_id):
+        memory = self.cache.get(user_id)
+        if memory is not None:
+            self.cache.move_to_end(user_id)
+        return memory
+
+    def put(self, user_id, memory):
+        self.cache[user_id] = memory
+        self.cache.move_to_end(user_id)
+        while len(self.cache) > self.cache_size:
+            evicted_id, _ = self.cache.popitem(last=False)
+            self.log.debug(f"Evicted user {evicted_id} from memory cache")
+
+    def load(self, user_id):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT memory FROM user_threads WHERE user_id = ?", (user_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        try:
+            memory = self.deserialize(row[0])
+        except Exception as e:
+            self.log.error(f"Error loading thread for user {user_id}, moving it to corrupt_threads: {e}")
+            self.move_aside(user_id, row[0], e)
+            return None
+        if self.on_load:
+            self.on_load(memory)
+        return memory
+
+    def move_aside(self, user_id, data, error):
+        # The user starts over with an empty thread, the unreadable one is kept for recovery.
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                self.connection.execute(
+                    "INSERT INTO corrupt_threads (user_id, memory, error, moved_at) VALUES (?, ?, ?, ?)",
+                    (user_id, data, f"{type(error).__name__}: {error}", time.time())
+                )
+                self.connection.execute("DELETE FROM user_threads WHERE user_id = ? AND memory = ?", (user_id, data))
+                self.connection.execute("COMMIT")
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+
+    def serialize(self, memory):
+        return pickle.dumps(memory, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def deserialize(self, data):
+        return pickle.loads(data)
+
+    def write(self, user_id, data):
+        with self.lock:
+            self.connection.execute(
+                "INSERT INTO user_threads (user_id, memory, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET memory = excluded.memory, updated_at = excluded.updated_at",
+                (user_id, data, time.time())
+            )
+
+    def save(self, user_id, memory):
+        self.put(user_id, memory)
+        self.write(user_id, self.serialize(memory))
+
+    def evict(self, user_id):
+        self.cache.pop(user_id, None)
+
+    def remove(self, user_id):
+        with self.lock:
+            self.connection.execute("DELETE FROM user_threads WHERE user_id = ?", (user_id,))
+
+    def migrate_pickle(self, pickle_path):
+        """
+        One-time import of a legacy user_threads.pkl. The pickle is renamed once all of
+        its users have been written, so the migration does not run again.
+        """
+        if not os.path.exists(pickle_path):
+            return 0
+        self.log.info(f"Migrating user threads from {pickle_path}")
+        with open(pickle_path, 'rb') as file:
+            user_threads = pickle.load(file)
+        rows = [(str(user_id), self.serialize(memory), time.time()) for user_id, memory in user_threads.items()]
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                self.connection.executemany(
+                    "INSERT OR IGNORE INTO user_threads (user_id, memory, updated_at) VALUES (?, ?, ?)",
+                    rows
+                )
+                self.connection.execute("COMMIT")
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+        os.replace(pickle_path, f"{pickle_path}.migrated")
+        self.log.info(f"Migrated {len(rows)} user threads to {self.db_path}")
+        return len(rows)
+
+    def delete(self, user_id):
+        self.evict(user_id)
+        self.remove(user_id)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        with self.lock:
+            self.connection.close()
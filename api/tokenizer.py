@@ -0,0 +1,43 @@
+import logging
+
+DEFAULT_ENCODING = "cl100k_base"
+
+log = logging.getLogger(__name__)
+_encodings = {}
+
+def get_encoding(model=None):
+    """
+    Returns the tiktoken encoding for a model, loading it once per process.
+    Models tiktoken does not know about (e.g. Groq models) fall back to cl100k_base.
+    """
+    encoding = _encodings.get(model)
+    if encoding is None:
+        # Imported on first use, BaseChatHandler.warmup loads it at startup.
+        import tiktoken
+        try:
+            encoding = tiktoken.encoding_for_model(model) if model else tiktoken.get_encoding(DEFAULT_ENCODING)
+        except KeyError:
+            log.debug(f"No tiktoken encoding for model {model}, using {DEFAULT_ENCODING}.")
+            encoding = tiktoken.get_encoding(DEFAULT_ENCODING)
+        _encodings[model] = encoding
+    return encoding
+
+def token_count(text, model=None):
+    try:
+        return len(get_encoding(model).encode(text))
+    except Exception as e:
+        log.error(f"Failed to count tokens: {e}")
+        return 0
+
+def message_token_count(message, model=None):
+    """
+    Counts the tokens of a single history entry, formatted the same way the
+    memory aggregates messages ("role: content\\n"). Counts are not cached here,
+    Memory keeps the counts of its history. Takes a Message or a role/content dict.
+    """
+    if isinstance(message, dict):
+        return token_count(f"{message['role']}: {message['content']}\n", model)
+    return token_count(f"{message.role.value}: {message.content}\n", model)
+
+def messages_token_count(messages, model=None):
+    return sum(message_token_count(message, model) for message in messages)
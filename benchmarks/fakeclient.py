@@ -0,0 +1,78 @@
+import asyncio
+import random
+from types import SimpleNamespace
+from api.tokenizer import token_count
+
+class FakeResponse:
+    def __init__(self, content, usage):
+        self.choices = [SimpleNamespace(message=SimpleNamespace(role="assistant", content=content), finish_reason="stop")]
+        self.usage = usage
+
+class FakeChunk:
+    def __init__(self, content=None, usage=None):
+        self.choices = [SimpleNamespace(delta=SimpleNamespace(content=content))] if content is not None else []
+        self.usage = usage
+
+class FakeRawResponse:
+    def __init__(self, response, headers):
+        self.response = response
+        self.headers = headers
+
+    def parse(self):
+        return self.response
+
+class FakeClient:
+    """
+    Stands in for AsyncOpenAI/AsyncGroq in benchmarks. Replies are reply_tokens words long
+    and arrive after a fixed latency, or one sampled from a lognormal distribution around
+    latency when latency_sigma is set. Streams yield one chunk per word, spread over the
+    latency. Time spent in simulated latency is tracked so it can be subtracted from
+    measured timings.
+    """
+    def __init__(self, latency=0.0, latency_sigma=None, reply_tokens=64, cached_ratio=0.0, seed=0):
+        self.latency = latency
+        self.latency_sigma = latency_sigma
+        self.reply_tokens = reply_tokens
+        self.cached_ratio = cached_ratio
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.simulated_latency = 0.0
+        completions = SimpleNamespace(create=self.create)
+        completions.with_raw_response = SimpleNamespace(create=self.create_raw)
+        self.chat = SimpleNamespace(completions=completions)
+
+    def sample_latency(self):
+        if not self.latency:
+            return 0.0
+        if self.latency_sigma:
+            return self.random.lognormvariate(0.0, self.latency_sigma) * self.latency
+        return self.latency
+
+    def usage(self, messages, model, content):
+        # Estimated from the length, counting the prompt here would be charged to the bot's overhead.
+        prompt_tokens = sum(len(message['content']) for message in messages) // 4
+        details = SimpleNamespace(cached_tokens=int(prompt_tokens * self.cached_ratio))
+        return SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=token_count(content, model), prompt_tokens_details=details)
+
+    async def create(self, messages, model=None, stream=False, **params):
+        self.requests += 1
+        latency = self.sample_latency()
+        self.simulated_latency += latency
+        content = " ".join(f"word{i}" for i in range(self.reply_tokens))
+        if stream:
+            return self.stream(content, latency, self.usage(messages, model, content))
+        if latency:
+            await asyncio.sleep(latency)
+        return FakeResponse(content, self.usage(messages, model, content))
+
+    async def create_raw(self, **params):
+        return FakeRawResponse(await self.create(**params), {})
+
+    async def stream(self, content, latency, usage):
+        words = content.split(" ")
+        delay = latency / len(words)
+        for index, word in enumerate(words):
+            if delay:
+                await asyncio.sleep(delay)
+            yield FakeChunk(word if index == 0 else f" {word}")
+        yield FakeChunk(usage=usage)
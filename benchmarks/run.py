@@ -0,0 +1,291 @@
+"""
+Offline benchmarks for the chat handler. Provider calls go to a FakeClient, so the numbers
+measure the bot's own overhead (prompt building, token counting, memory, persistence) rather
+than provider latency. Each case runs in a fresh process so peak RSS is per case.
+
+    python -m benchmarks.run --users 1,100,10000 --output results.json
+    python -m benchmarks.run --baseline results.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+import metrics
+from api.basechathandler import BaseChatHandler
+from api.memory import Memory
+from api.shardedhandler import ShardedHandler
+from .fakeclient import FakeClient
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+AI_NAME = "SampleBot"
+TEMPLATE = "sample_template"
+SCENARIOS = ("response", "stream", "memory", "summary", "prompt", "save", "sharded")
+# Messages per user before the benchmark starts.
+HISTORIES = {'short': 10, 'long': 100}
+VOCABULARY = (
+    "the a to and of in is it you that was for on are with as have be at this not but what all "
+    "were when we there can an your which their said if do will each about how up out them then "
+    "she many some so these would other into has more her two like him see time could no make "
+    "than first been its who now people my made over did down only way find use may water long "
+    "little very after words called just where most know get through back much before go good "
+    "new write our used me man too any day same right look think also around another came come "
+    "work three word must because does part even place well such here take why things help "
+    "volcano recipe weekend garden music travel weather project deadline birthday movie"
+).split()
+
+class BenchmarkHandler(BaseChatHandler):
+    provider = 'benchmark'
+
+    def __init__(self, api_key, ai_name, template, client=None, client_options=None, **kwargs):
+        # client_options builds the client in place, for handlers started in worker processes.
+        self.fake_client = client or FakeClient(**(client_options or {}))
+        super().__init__(api_key, ai_name, template, **kwargs)
+
+    def initialize_client(self):
+        return self.fake_client
+
+def sentence(rng, words):
+    return " ".join(rng.choice(VOCABULARY) for _ in range(words))
+
+def user_name(user_id):
+    return f"user{user_id}"
+
+def percentile(values, percentile):
+    values = sorted(values)
+    return values[min(int(len(values) * percentile), len(values) - 1)] if values else 0.0
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere.
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def populate(handler, users, history, rng):
+    """
+    Writes a history of the given length for every user to the thread store. The most
+    recent users stay in its LRU, like on a running bot.
+    """
+    for user_id in map(str, range(users)):
+        memory = Memory(**handler.memory_config)
+        for index in range(history):
+            role = "user" if index % 2 == 0 else "assistant"
+            memory.message_history.extend(handler.messages.create_message(sentence(rng, 40), role=role))
+        memory.history_token_counts()
+        handler.user_threads.save(user_id, memory)
+
+async def run_turns(handler, users, turns, concurrency, rng, stream):
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def converse(user_id):
+        user = {user_id: user_name(user_id)}
+        for _ in range(turns):
+            text = sentence(rng, 20)
+            async with semaphore:
+                started = time.perf_counter()
+                if stream:
+                    async for _ in handler.stream_ai_response(text, user):
+                        pass
+                else:
+                    await handler.get_ai_response(text, user)
+                latencies.append(time.perf_counter() - started)
+
+    await asyncio.gather(*(converse(user_id) for user_id in map(str, range(users))))
+    # Summaries triggered by the turns are part of the cost of a turn. Sharded handlers drain them on close.
+    if not isinstance(handler, ShardedHandler):
+        await handler.summarizer.drain()
+    return latencies
+
+async def run_per_user(handler, scenario, users, rng):
+    latencies = []
+    for user_id in map(str, range(users)):
+        user = {user_id: user_name(user_id)}
+        memory = handler.get_user_thread(user_id)
+        if scenario == "memory":
+            messages = handler.messages.create_message(sentence(rng, 20), role="user")
+            messages.extend(handler.messages.create_message(sentence(rng, 40), role="assistant"))
+            started = time.perf_counter()
+            memory.update(messages, user)
+        elif scenario == "summary":
+            # Fold half of the history, whatever its length.
+            memory.high_watermark = memory.history_tokens // 2
+            memory.low_watermark = memory.high_watermark // 2
+            started = time.perf_counter()
+            await memory.update_summary(user)
+        elif scenario == "prompt":
+            user_input = handler.messages.create_message(sentence(rng, 20), role="user")
+            started = time.perf_counter()
+            handler.prompt_builder.build_prompt(user, user_input, memory)
+        else:
+            started = time.perf_counter()
+            await handler.save_user_threads(user_id)
+        latencies.append(time.perf_counter() - started)
+    return latencies
+
+async def run_scenario(handler, case, rng):
+    if case['scenario'] in ("response", "stream", "sharded"):
+        return await run_turns(handler, case['users'], case['turns'], case['concurrency'], rng, case['scenario'] == "stream")
+    return await run_per_user(handler, case['scenario'], case['users'], rng)
+
+def sharded_handler(handler_kwargs, workers):
+    # Workers load the populated threads from the store, so they start with the same histories.
+    return ShardedHandler(__name__, "BenchmarkHandler", handler_kwargs, workers, log_level=logging.CRITICAL)
+
+def run_case(case):
+    """
+    Runs a single benchmark case in the current process and returns its result.
+    """
+    logging.disable(logging.CRITICAL)
+    metrics.registry.enabled = case['metrics']
+    shutil.rmtree(os.path.join("logs", AI_NAME), ignore_errors=True)
+    rng = random.Random(case['seed'])
+    client_options = {'latency': case['latency'], 'latency_sigma': case['latency_sigma'], 'reply_tokens': case['reply_tokens'], 'seed': case['seed']}
+    client = FakeClient(**client_options)
+    handler_kwargs = {
+        'api_key': "benchmark", 'ai_name': AI_NAME, 'template': TEMPLATE, 'model': case['model'],
+        'memory_cache_size': case['cache_size'], 'max_concurrent_requests': case['concurrency']
+    }
+
+    async def main():
+        handler = BenchmarkHandler(client=client, **handler_kwargs)
+        populate(handler, case['users'], HISTORIES[case['history']], rng)
+        if case['scenario'] == "sharded":
+            await handler.close()
+            handler = sharded_handler(dict(handler_kwargs, client_options=client_options), case['workers'])
+        started = time.perf_counter()
+        latencies = await run_scenario(handler, case, rng)
+        elapsed = time.perf_counter() - started
+        await handler.close()
+        return latencies, elapsed
+
+    latencies, elapsed = asyncio.run(main())
+    # The sharded scenario's clients live in the workers.
+    in_process = case['scenario'] != "sharded"
+    return {
+        'scenario': case['scenario'],
+        'users': case['users'],
+        'history': case['history'],
+        'operations': len(latencies),
+        'seconds': round(elapsed, 4),
+        'throughput': round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        'workers': 1 if in_process else case['workers'],
+        'provider_requests': client.requests if in_process else None,
+        'simulated_provider_seconds': round(client.simulated_latency, 4) if in_process else None,
+        'peak_rss_mb': round(peak_rss_mb(), 1)
+    }
+
+def run_isolated(case):
+    with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as executor:
+        return executor.submit(run_case, case).result()
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+def case_key(result):
+    return (result['scenario'], result['users'], result['history'])
+
+def compare(results, baseline_path, tolerance):
+    """
+    Prints throughput relative to an earlier results file and returns the cases that
+    slowed down by more than tolerance.
+    """
+    with open(baseline_path, 'r') as file:
+        baseline = {case_key(result): result for result in json.load(file)['results']}
+    regressions = []
+    for result in results:
+        previous = baseline.get(case_key(result))
+        if previous is None or not previous['throughput']:
+            continue
+        ratio = result['throughput'] / previous['throughput']
+        print(f"{result['scenario']:>8} {result['users']:>6} users {result['history']:>5}: {ratio:6.2f}x throughput, {result['peak_rss_mb'] - previous['peak_rss_mb']:+.1f} MB peak RSS")
+        if ratio < 1 - tolerance:
+            regressions.append(result)
+    return regressions
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Benchmarks the chat handler against a fake provider.")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="comma separated scenarios to run")
+    parser.add_argument("--users", default="1,100,10000", help="comma separated user counts")
+    parser.add_argument("--histories", default=",".join(HISTORIES), help="comma separated history lengths (short, long)")
+    parser.add_argument("--turns", type=int, default=2, help="turns per user in the response, stream and sharded scenarios")
+    parser.add_argument("--concurrency", type=int, default=16, help="users served at once in the response, stream and sharded scenarios")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="worker processes in the sharded scenario")
+    parser.add_argument("--latency", type=float, default=0.0, help="simulated provider latency in seconds")
+    parser.add_argument("--latency-sigma", type=float, default=None, help="sample latencies from a lognormal distribution with this sigma")
+    parser.add_argument("--reply-tokens", type=int, default=64, help="words per simulated reply")
+    parser.add_argument("--cache-size", type=int, default=1024, help="memory_cache_size of the handler")
+    parser.add_argument("--model", default="gpt-4o")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--metrics", action="store_true", help="record metrics during the run, to measure their overhead")
+    parser.add_argument("--output", default="bench_results.json", help="file to write the results to")
+    parser.add_argument("--baseline", default=None, help="earlier results file to compare throughput against")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="throughput drop against the baseline counted as a regression")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    output = os.path.abspath(args.output)
+    baseline = os.path.abspath(args.baseline) if args.baseline else None
+    cases = [
+        {
+            'scenario': scenario, 'users': int(users), 'history': history, 'turns': args.turns,
+            'concurrency': args.concurrency, 'latency': args.latency, 'latency_sigma': args.latency_sigma,
+            'reply_tokens': args.reply_tokens, 'cache_size': args.cache_size, 'model': args.model, 'seed': args.seed,
+            'metrics': args.metrics, 'workers': args.workers
+        }
+        for scenario in args.scenarios.split(",")
+        for users in args.users.split(",")
+        for history in args.histories.split(",")
+    ]
+
+    # Handlers write to ./logs and read ./instructions, so run in a scratch directory.
+    workdir = tempfile.mkdtemp(prefix="chatbot-bench-")
+    os.symlink(os.path.join(ROOT, "instructions"), os.path.join(workdir, "instructions"))
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    results = []
+    try:
+        for case in cases:
+            result = run_isolated(case)
+            results.append(result)
+            print(f"{result['scenario']:>8} {result['users']:>6} users {result['history']:>5}: {result['throughput']:>10.1f} ops/s  p50 {result['p50_ms']:>8.3f} ms  p99 {result['p99_ms']:>8.3f} ms  peak RSS {result['peak_rss_mb']:>7.1f} MB")
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'created_at': time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        'options': {key: value for key, value in vars(args).items() if key not in ("output", "baseline")},
+        'results': results
+    }
+    with open(output, 'w') as file:
+        json.dump(report, file, indent=2)
+    print(f"Wrote {len(results)} results to {output}")
+
+    if baseline:
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} cases regressed by more than {args.tolerance:.0%}")
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
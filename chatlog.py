@@ -0,0 +1,143 @@
+import asyncio
+import gzip
+import json
+import logging
+import metrics
+import os
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+class ChatLogWriter:
+    """
+    Writes chat and error logs from a background task. Entries are queued without
+    blocking the caller, written to one open file per (user, kind, day) and flushed
+    every flush_interval seconds. Files are rotated when the day changes. At most
+    max_open_files stay open, the least recently written are closed first, and files
+    not written for idle_timeout seconds are closed on flush.
+    """
+    def __init__(self, log_directory, log_format="text", compress=False, flush_interval=1.0, fsync=False, max_open_files=64, idle_timeout=60.0):
+        if log_format not in ("text", "jsonl"):
+            raise ValueError(f"Unknown chat log format: {log_format}")
+        self.log = logging.getLogger(__name__)
+        self.log_directory = log_directory
+        self.log_format = log_format
+        self.compress = compress
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.max_open_files = max_open_files
+        self.idle_timeout = idle_timeout
+        self.queue = None
+        self.task = None
+        self.handles = OrderedDict()
+
+    def write(self, user_name, text, error=False):
+        if self.task is None:
+            self.queue = asyncio.Queue()
+            self.task = asyncio.create_task(self._run())
+        self.queue.put_nowait((datetime.now(), user_name, text, error))
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        last_flush = loop.time()
+        while True:
+            try:
+                entry = await asyncio.wait_for(self.queue.get(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                entry = ()
+            if entry is None:
+                break
+            batch = [entry] if entry else []
+            while not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            stop = None in batch
+            with metrics.span("chat_log_write"):
+                self.write_batch(entry for entry in batch if entry is not None)
+            if stop:
+                break
+            if loop.time() - last_flush >= self.flush_interval:
+                # The writer has to outlive a failed flush, or every later log would be dropped.
+                try:
+                    with metrics.span("chat_log_flush"):
+                        await loop.run_in_executor(None, self.flush)
+                except Exception as e:
+                    self.log.error(f"Error flushing chat logs: {e}")
+                last_flush = loop.time()
+        try:
+            await loop.run_in_executor(None, self.close_handles)
+        except Exception as e:
+            self.log.error(f"Error closing chat logs: {e}")
+
+    def write_batch(self, entries):
+        for timestamp, user_name, text, error in entries:
+            try:
+                self.file_for(user_name, error, timestamp.strftime('%Y%m%d')).write(self.format_entry(timestamp, user_name, text, error))
+            except Exception as e:
+                self.log.error(f"Error writing chat log for {user_name}: {e}")
+
+    def format_entry(self, timestamp, user_name, text, error):
+        if self.log_format == "jsonl":
+            record = {
+                'time': timestamp.astimezone().isoformat(),
+                'user': user_name,
+                'type': "error" if error else "chat",
+                'text': text
+            }
+            return json.dumps(record, ensure_ascii=False) + "\n"
+        return text + "\n" + "\n"
+
+    def file_for(self, user_name, error, day):
+        kind = "errors" if error else "chat"
+        key = (user_name, kind)
+        handle = self.handles.get(key)
+        if handle is not None and handle[0] == day:
+            self.handles[key] = (day, handle[1], time.monotonic())
+            self.handles.move_to_end(key)
+            return handle[1]
+        if handle is not None:
+            self.close_handle(key)
+        while len(self.handles) >= self.max_open_files:
+            self.close_handle(next(iter(self.handles)))
+        log_dir = os.path.join(self.log_directory, user_name)
+        os.makedirs(log_dir, exist_ok=True)
+        extension = "jsonl" if self.log_format == "jsonl" else "txt"
+        file_path = os.path.join(log_dir, f"{kind}_{day}.{extension}")
+        if self.compress:
+            file = gzip.open(f"{file_path}.gz", "at", encoding="utf-8")
+        else:
+            file = open(file_path, "a", encoding="utf-8")
+        self.handles[key] = (day, file, time.monotonic())
+        return file
+
+    def close_handle(self, key):
+        day, file, last_write = self.handles.pop(key)
+        try:
+            file.close()
+        except Exception as e:
+            self.log.error(f"Error closing chat log {key}: {e}")
+
+    def flush(self):
+        today = datetime.now().strftime('%Y%m%d')
+        now = time.monotonic()
+        for key, (day, file, last_write) in list(self.handles.items()):
+            try:
+                if day != today or now - last_write >= self.idle_timeout:
+                    self.close_handle(key)
+                    continue
+                file.flush()
+                if self.fsync and not self.compress:
+                    os.fsync(file.fileno())
+            except Exception as e:
+                self.log.error(f"Error flushing chat log {key}: {e}")
+
+    def close_handles(self):
+        self.flush()
+        for key in list(self.handles):
+            self.close_handle(key)
+
+    async def close(self):
+        if self.task is None:
+            return
+        self.queue.put_nowait(None)
+        await self.task
+        self.task = None
@@ -6,25 +6,77 @@ pyrogram_api_hash = 'your-pyrogram-api-hash-here'
 
 ### LLM configurations ###
 #assistant_id = 'your-openai-assistant-id-here' #if using the openai assistants api
+#run_poll_interval=0.25 # Initial seconds between status checks of an assistants api run, doubles up to run_max_poll_interval, default is 0.25
+#run_max_poll_interval=2.0 # Maximum seconds between status checks of an assistants api run, default is 2.0
+#run_timeout=600 # Seconds after which an unfinished assistants api run is cancelled, default is 600
 model='gpt-3.5-turbo' # Required if not using assistants api. Model to use, can be any model available in the API, check api documentation for more details
 #max_tokens=512 # Maximum tokens to generate, can be any number between 1 and 4096, default is 512
 #temperature=1 # Temperature for sampling, can be any number between 0 and 1, default is 1
 #top_p=1 # Top P value for nucleus sampling, can be any number between 0 and 1, default is 1
 #memory_max_tokens=16384 # Maximum tokens to use for memory, can be any number between 1 and and your model's max contecxt length, default is 16384
+#memory_high_watermark=8192 # Token count of the message history that triggers a summary update, default is half of memory_max_tokens
+#memory_low_watermark=4096 # The oldest messages are folded into the summary in one call until the history is below this token count, default is half of memory_high_watermark
 #memory_model='gpt-4o' # Model to use for memory, defaults to the same model as the main model
+#summary_concurrency=2 # Maximum number of summary updates running at once in the background, default is 2
+#stream=True # Stream replies into Telegram as they are generated instead of waiting for the full response, default is False
+#stream_edit_interval=1.0 # Minimum seconds between edits of a streamed reply, keeps the bot under Telegram's edit rate limits, default is 1.0
+#max_concurrent_requests=16 # Maximum number of requests in flight to the provider at once, summaries included, default is 16
+#http_max_connections=100 # Size of the HTTP connection pool shared by all provider clients, default is 100
+#requests_per_minute=500 # Requests per minute allowed by your provider tier, requests are queued to stay under it, unlimited by default
+#tokens_per_minute=200000 # Tokens per minute allowed by your provider tier, requests are queued to stay under it, unlimited by default
+#max_retries=4 # Retries for rate limited and transient provider errors, with jittered exponential backoff, default is 4
+#prompt_layout='default' # 'cache' keeps the system message static and puts the summary after the history, so providers can reuse cached prompt prefixes between turns, default is 'default'
+#context_window=16385 # Context length of the model, defaults to the known length of the configured model (8192 for unknown models). Prompts are trimmed to fit it with room left for max_tokens
+#retrieval_top_k=0 # Number of archived messages (folded into the summary earlier) recalled into the prompt by full-text search on the new input, 0 disables the archive, default is 0
+#retrieval_max_tokens=256 # Token budget for recalled messages, default is 256
+#memory_cache_size=1024 # Number of users whose memory is kept loaded, the rest are loaded from ./logs/<ai_name>/user_threads.db on demand, default is 1024
+#response_cache_size=0 # Number of first replies of conversations kept in a cache keyed by a hash of the system message, the input without its timestamp, model and sampling settings, a new conversation opening with a cached question reuses the reply instead of calling the provider, 0 disables it, default is 0
+#response_cache_ttl=3600 # Seconds a cached reply is reused, default is 3600
+#shard_workers=4 # Run the handler in this many worker processes, users are assigned to workers by a hash of their id. Provider limits above are split between the workers, disabled by default
+#shard_call_timeout=600 # Seconds to wait for a handler worker to answer before the request fails, a worker that exits is restarted, default is 600
 
 allowed_users = { # Dictionary of allowed users and their respective user ids, user IDs can be found by messaging https://t.me/userinfobot
     'SampleUser': 123456789,
     'SampleUser2': 987654321
 }
 
+#max_concurrent_users=16 # Maximum number of users being answered at once, further users wait their turn round-robin, default is 16
+#max_backlog=500 # Maximum number of queued messages across all users, messages beyond it get a busy reply, default is 500
+#busy_message="I'm a bit overwhelmed right now, please try again in a moment." # Reply sent when the backlog is full
+#coalesce_window=1.5 # Seconds to wait for more messages before answering, messages sent within the window or while a reply is being generated are answered together in one turn, 0 merges only the latter, disabled by default
+#redelivery_cache_size=1024 # Number of recently answered messages whose reply is remembered, a message Telegram delivers again after a reconnect gets the stored reply instead of a new answer, 0 disables it, default is 1024
+
 ### Naming and logging configurations ###
 ai_name = 'SampleBot' # Name of the AI
 #user_threads_file = 'sample_user_threads_filename.json' # file to store user threads in, required when using the assistant handler
 log_directory = './logs/SampleBot/'
+#chat_log_format = 'text' # Format of the per user chat logs, 'text' or 'jsonl', default is 'text'
+#chat_log_compress = False # Write chat logs gzip compressed, default is False
+#chat_log_flush_interval = 1.0 # Seconds between flushes of buffered chat log writes, default is 1.0
+#chat_log_fsync = False # fsync chat logs on every flush, default is False
+#chat_log_max_open_files = 64 # Maximum number of chat log files kept open, the least recently written are closed first, default is 64
+#training_data_file = './logs/SampleBot/training_data.jsonl' # Adds like and fire buttons to replies, liked replies are saved with the message that prompted them as training examples in this JSONL file, disabled by default
+#training_data_max_replies = 4096 # Number of most recent replies whose reactions can still be saved, default is 4096
+#training_data_batch_size = 50 # Number of buffered training examples that triggers a write, default is 50
+#training_data_flush_interval = 5.0 # Seconds between writes of buffered training examples, default is 5.0
+#metrics_port = 9464 # Serve per-stage latency histograms and counters in the Prometheus text format at http://<metrics_host>:<metrics_port>/metrics, disabled by default
+#metrics_host = '127.0.0.1' # Address the metrics endpoint listens on, default is '127.0.0.1'
+#metrics_snapshot_file = './logs/SampleBot/metrics.json' # Periodically write a JSON snapshot of the metrics to this file, disabled by default
+#metrics_snapshot_interval = 60 # Seconds between metrics snapshots, default is 60
 template = 'sample_template'
 
 ### Handler class ###
 handler_class = 'GPTChatHandler'
 #handler_class = 'GPTAssistantHandler'
-#handler_class = 'GroqHandler'
\ No newline at end of file
+#handler_class = 'GroqHandler'
+#handler_class = 'RouterHandler'
+
+### Router configurations, used with the RouterHandler ###
+#backends = [ # Backends to route between, each request goes to the fastest healthy one. Optional keys: name, memory_model, max_concurrent_requests, requests_per_minute, tokens_per_minute, max_retries (default 1)
+#    {'provider': 'groq', 'api_key': 'your-groq-api-key-here', 'model': 'llama3-70b-8192'},
+#    {'provider': 'openai', 'api_key': 'your-openai-api-key-here', 'model': 'gpt-4o'},
+#]
+#hedge_requests = False # Send a duplicate request to the next backend when the first one is slower than usual and keep whichever answers first, default is False
+#hedge_percentile = 0.95 # Latency percentile of the chosen backend after which a hedged request is sent, default is 0.95
+#hedge_min_delay = 1.0 # Minimum seconds to wait before sending a hedged request, default is 1.0
+#backend_cooldown = 30.0 # Seconds a failing backend is skipped before it is tried again, default is 30
\ No newline at end of file
@@ -1,8 +1,13 @@
 import os
+import re
 import json
 import logging
 from datetime import datetime
 
+_file_cache = {}
+_missing_file = (None, None)
+_user_input_prefix = re.compile(r"^\d{4}-\d{2}-\d{2}T[\d:]+(?:[+-][\d:]+|Z)?, \w+ - [^:\n]*: ", re.MULTILINE)
+
 def setup_logging(debug=False):
     level = logging.DEBUG if debug else logging.INFO
     logging.basicConfig(level=level,
@@ -16,6 +21,13 @@ def format_user_input(user_name, user_input):
     datetime_iso = iso_datetime_day()
     return f"{datetime_iso}{user_name}: {user_input}"
 
+def strip_user_input_prefix(text):
+    """
+    Returns the text of user input formatted by format_user_input without the timestamp and
+    username of each message.
+    """
+    return _user_input_prefix.sub("", text)
+
 def iso_datetime_day():
     """
     Generates an ISO datetime string along with the day of the week.
@@ -53,23 +65,52 @@ def load_json(file_path):
         logging.info(f"JSON file not found at {file_path}, creating a new one.")
         return {}
     
+def read_cached(file_path):
+    """
+    Returns the contents of the file at file_path, cached in-process. The file is only
+    re-read when its modification time or size changes, so edits take effect without a restart.
+    """
+    try:
+        stat = os.stat(file_path)
+    except FileNotFoundError:
+        if _file_cache.get(file_path) is not _missing_file:
+            _file_cache.pop(file_path, None)
+        raise
+    version = (stat.st_mtime_ns, stat.st_size)
+    cached = _file_cache.get(file_path)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    with open(file_path, 'r') as file:
+        content = file.read()
+    _file_cache[file_path] = (version, content)
+    return content
+
+def report_missing(file_path):
+    """
+    Returns True the first time file_path is found missing, so it is only logged once until it appears.
+    """
+    if _file_cache.get(file_path) is _missing_file:
+        return False
+    _file_cache[file_path] = _missing_file
+    return True
+
 def load_character_sheet(sub_dir, sheet = None):
     sub_dir = str(sub_dir).lower()
     sheet = str(sheet).lower() if sheet is not None else sub_dir
 
     file_path = f"./instructions/{sub_dir}/{sheet.lower()}.txt"
     try:
-        with open(file_path, 'r') as file:
-            return file.read()
+        return read_cached(file_path)
     except FileNotFoundError:
-        logging.error(f"Character sheet {sheet} not found.")
+        if report_missing(file_path):
+            logging.error(f"Character sheet {sheet} not found.")
         return ""
     
 def load_template(template_name):
-    file_path = file_path = f"./instructions/templates/{template_name}.txt"
+    file_path = f"./instructions/templates/{template_name}.txt"
     try:
-        with open(file_path, 'r') as file:
-            return file.read()
+        return read_cached(file_path)
     except FileNotFoundError:
-        logging.error(f"template {template_name} not found.")
+        if report_missing(file_path):
+            logging.error(f"template {template_name} not found.")
         return ""
\ No newline at end of file
@@ -0,0 +1,228 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from bisect import bisect_left
+from contextlib import nullcontext
+
+# Upper bounds in seconds, spanning cached template reads up to slow provider calls.
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+PREFIX = "chatbot_"
+
+_null_span = nullcontext()
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            yield bound, total
+
+    def quantile(self, q):
+        """
+        Estimates a quantile as the upper bound of the bucket it falls in.
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        for bound, total in self.cumulative():
+            if total >= rank:
+                return bound if bound != float("inf") else self.buckets[-1]
+        return self.buckets[-1]
+
+class Span:
+    __slots__ = ('registry', 'stage', 'started')
+
+    def __init__(self, registry, stage):
+        self.registry = registry
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.registry.observe("stage_seconds", time.perf_counter() - self.started, stage=self.stage)
+        return False
+
+class MetricsRegistry:
+    """
+    In-process counters and histograms. Recording is a no-op until the registry is
+    enabled, and is meant to be called from the event loop thread. Metrics can be
+    served in the Prometheus text format and written to a JSON snapshot file.
+    """
+    def __init__(self):
+        self.log = logging.getLogger(__name__)
+        self.enabled = False
+        self.counters = {}
+        self.histograms = {}
+        self.server = None
+        self.snapshot_file = None
+        self.snapshot_task = None
+
+    def span(self, stage):
+        if not self.enabled:
+            return _null_span
+        return Span(self, stage)
+
+    def observe(self, name, value, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(value)
+
+    def increment(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def drain(self):
+        """
+        Returns the counters and histograms recorded since the last drain and clears them,
+        in a picklable form that merge() adds to another registry.
+        """
+        counters, histograms = self.counters, self.histograms
+        self.counters, self.histograms = {}, {}
+        return counters, {key: (histogram.counts, histogram.sum, histogram.count) for key, histogram in histograms.items()}
+
+    def merge(self, counters, histograms):
+        if not self.enabled:
+            return
+        for key, value in counters.items():
+            self.counters[key] = self.counters.get(key, 0) + value
+        for key, (counts, total, count) in histograms.items():
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.counts = [a + b for a, b in zip(histogram.counts, counts)]
+            histogram.sum += total
+            histogram.count += count
+
+    def render(self):
+        lines = []
+        for name, series in self.grouped(self.counters).items():
+            lines.append(f"# TYPE {PREFIX}{name} counter")
+            for labels, value in series:
+                lines.append(f"{PREFIX}{name}{format_labels(labels)} {value}")
+        for name, series in self.grouped(self.histograms).items():
+            lines.append(f"# TYPE {PREFIX}{name} histogram")
+            for labels, histogram in series:
+                for bound, total in histogram.cumulative():
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f"{PREFIX}{name}_bucket{format_labels(labels + (('le', le),))} {total}")
+                lines.append(f"{PREFIX}{name}_sum{format_labels(labels)} {histogram.sum}")
+                lines.append(f"{PREFIX}{name}_count{format_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def grouped(self, metrics):
+        groups = {}
+        for (name, labels), value in sorted(metrics.items()):
+            groups.setdefault(name, []).append((labels, value))
+        return groups
+
+    def snapshot(self):
+        return {
+            'time': time.time(),
+            'counters': [{'name': name, 'labels': dict(labels), 'value': value} for (name, labels), value in sorted(self.counters.items())],
+            'histograms': [
+                {
+                    'name': name,
+                    'labels': dict(labels),
+                    'count': histogram.count,
+                    'sum': histogram.sum,
+                    'p50': histogram.quantile(0.5),
+                    'p99': histogram.quantile(0.99)
+                }
+                for (name, labels), histogram in sorted(self.histograms.items())
+            ]
+        }
+
+    async def start(self, host="127.0.0.1", port=None, snapshot_file=None, snapshot_interval=60.0):
+        self.enabled = True
+        if port:
+            self.server = await asyncio.start_server(self.handle_request, host, port)
+            self.log.info(f"Serving metrics on http://{host}:{port}/metrics")
+        if snapshot_file:
+            self.snapshot_file = snapshot_file
+            self.snapshot_task = asyncio.create_task(self.write_snapshots(snapshot_file, snapshot_interval))
+
+    async def handle_request(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            while (await reader.readline()).strip():
+                pass
+            parts = request_line.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+                status, body = "200 OK", self.render().encode()
+            else:
+                status, body = "404 Not Found", b"Not found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except Exception as e:
+            self.log.warning(f"Error serving metrics: {e}")
+        finally:
+            writer.close()
+
+    async def write_snapshots(self, path, interval):
+        while True:
+            await asyncio.sleep(interval)
+            await self.write_snapshot(path)
+
+    async def write_snapshot(self, path):
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, write_json, path, self.snapshot())
+        except Exception as e:
+            self.log.error(f"Error writing metrics snapshot to {path}: {e}")
+
+    async def stop(self):
+        if self.snapshot_task is not None:
+            self.snapshot_task.cancel()
+            await asyncio.gather(self.snapshot_task, return_exceptions=True)
+            self.snapshot_task = None
+            await self.write_snapshot(self.snapshot_file)
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    pairs = ",".join(f'{key}="{escape_label(value)}"' for key, value in labels)
+    return "{" + pairs + "}"
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def write_json(path, data):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as file:
+        json.dump(data, file)
+    os.replace(tmp_path, path)
+
+registry = MetricsRegistry()
+span = registry.span
+observe = registry.observe
+increment = registry.increment
@@ -0,0 +1,105 @@
+import asyncio
+import logging
+import metrics
+import time
+from collections import deque
+
+class FairScheduler:
+    """
+    Runs per-user work with a global concurrency cap. Each user has a FIFO queue and at
+    most one job in flight; users with queued work are served round-robin, so a single
+    busy user cannot starve the others. Submissions beyond max_backlog are rejected.
+
+    With coalesce_window set, a user becomes ready that many seconds after their first
+    queued item, and each job receives all of the user's queued items at once.
+    """
+    def __init__(self, process, max_concurrency=16, max_backlog=500, coalesce_window=None):
+        self.log = logging.getLogger(__name__)
+        self.process = process
+        self.max_concurrency = max_concurrency
+        self.max_backlog = max_backlog
+        self.coalesce_window = coalesce_window
+        self.queues = {}
+        self.ready = None
+        self.running = set()
+        self.workers = []
+        self.backlog = 0
+        self.processed = 0
+        self.shed = 0
+        self.waits = deque(maxlen=1024)
+
+    def submit(self, user_id, item):
+        if self.backlog >= self.max_backlog:
+            self.shed += 1
+            metrics.increment("shed_messages_total")
+            self.log.warning(f"Backlog full ({self.backlog} queued), rejecting work for user {user_id}")
+            return False
+        if not self.workers:
+            self.start()
+        queue = self.queues.get(user_id)
+        if queue is None:
+            queue = self.queues[user_id] = deque()
+        queue.append((item, time.monotonic()))
+        self.backlog += 1
+        if len(queue) == 1 and user_id not in self.running:
+            if self.coalesce_window:
+                asyncio.get_running_loop().call_later(self.coalesce_window, self.ready.put_nowait, user_id)
+            else:
+                self.ready.put_nowait(user_id)
+        return True
+
+    def start(self):
+        self.ready = asyncio.Queue()
+        self.workers = [asyncio.create_task(self._worker()) for _ in range(self.max_concurrency)]
+
+    async def _worker(self):
+        while True:
+            user_id = await self.ready.get()
+            queue = self.queues.get(user_id)
+            if not queue:
+                continue
+            take = len(queue) if self.coalesce_window is not None else 1
+            now = time.monotonic()
+            items = []
+            for _ in range(take):
+                item, enqueued = queue.popleft()
+                self.waits.append(now - enqueued)
+                metrics.observe("queue_wait_seconds", now - enqueued)
+                items.append(item)
+            self.backlog -= take
+            self.running.add(user_id)
+            try:
+                await self.process(user_id, items)
+            except Exception as e:
+                self.log.error(f"Error processing work for user {user_id}: {e}", exc_info=True)
+            finally:
+                self.running.discard(user_id)
+                self.processed += 1
+            if queue:
+                self.ready.put_nowait(user_id)
+            else:
+                del self.queues[user_id]
+
+    def stats(self):
+        waits = sorted(self.waits)
+        return {
+            'queued': self.backlog,
+            'queued_users': len(self.queues) - len(self.running),
+            'active_users': len(self.running),
+            'processed': self.processed,
+            'shed': self.shed,
+            'wait_p50': waits[len(waits) // 2] if waits else 0.0,
+            'wait_max': waits[-1] if waits else 0.0
+        }
+
+    async def close(self, timeout=30.0):
+        """
+        Waits up to timeout seconds for queued and running work to finish, then stops the workers.
+        """
+        deadline = time.monotonic() + timeout
+        while (self.backlog or self.running) and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
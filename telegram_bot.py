@@ -2,131 +2,363 @@ import asyncio
 import importlib
 import sys
 import logging
-import os
-from pyrogram import Client, filters, handlers
-from datetime import datetime
+import time
+import metrics
+from pyrogram import Client, filters, handlers, idle
+from pyrogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+from api.clientpool import close_clients
+from api.responsecache import ResponseCache
+from chatlog import ChatLogWriter
+from scheduler import FairScheduler
+from trainingdata import TrainingDataWriter
 from lib import format_user_input, setup_logging
 
 debug_mode = False
 setup_logging(debug=debug_mode)
 
+TELEGRAM_MESSAGE_LIMIT = 4096
+REACTIONS = {"like": "👍", "fire": "🔥"}
+
 class TelegramBot:
     def __init__(self, config_module):
+        started = time.perf_counter()
         config = importlib.import_module(f"configs.{config_module}")
+        self.startup_timings = {'config': time.perf_counter() - started}
         self.log = logging.getLogger(__name__)
         self.debug = False
-        self.user_locks = {}
         self.processing_messages = set()
+        redelivery_cache_size = getattr(config, 'redelivery_cache_size', 1024)
+        # Pyrogram can redeliver updates after a reconnect, answered messages get their stored reply again.
+        self.replies = ResponseCache("redelivery", redelivery_cache_size) if redelivery_cache_size else None
+        started = time.perf_counter()
         self.handler = self.initialize_handler(config)
+        self.startup_timings['handler'] = time.perf_counter() - started
         self.allowed_users = config.allowed_users
         self.log_directory = config.log_directory
         self.ai_name = config.ai_name
         self.bot_token = config.telegram_token
         self.api_id = config.pyrogram_api_id
         self.api_hash = config.pyrogram_api_hash
+        self.stream_edit_interval = getattr(config, 'stream_edit_interval', 1.0)
+        self.scheduler = FairScheduler(
+            self.process_messages,
+            max_concurrency=getattr(config, 'max_concurrent_users', 16),
+            max_backlog=getattr(config, 'max_backlog', 500),
+            coalesce_window=getattr(config, 'coalesce_window', None)
+        )
+        self.busy_message = getattr(config, 'busy_message', "I'm a bit overwhelmed right now, please try again in a moment.")
+        self.chat_log = ChatLogWriter(
+            self.log_directory,
+            log_format=getattr(config, 'chat_log_format', 'text'),
+            compress=getattr(config, 'chat_log_compress', False),
+            flush_interval=getattr(config, 'chat_log_flush_interval', 1.0),
+            fsync=getattr(config, 'chat_log_fsync', False),
+            max_open_files=getattr(config, 'chat_log_max_open_files', 64)
+        )
+        training_data_file = getattr(config, 'training_data_file', None)
+        self.training_data = None
+        self.reaction_markup = None
+        self.liked_replies = None
+        if training_data_file:
+            self.training_data = TrainingDataWriter(
+                training_data_file,
+                batch_size=getattr(config, 'training_data_batch_size', 50),
+                flush_interval=getattr(config, 'training_data_flush_interval', 5.0)
+            )
+            # Maps the messages carrying the reaction buttons to the reply they show, Telegram's copy of the text has its formatting removed.
+            self.liked_replies = ResponseCache("reactions", getattr(config, 'training_data_max_replies', 4096))
+            self.reaction_markup = InlineKeyboardMarkup([[InlineKeyboardButton(emoji, callback_data=reaction) for reaction, emoji in REACTIONS.items()]])
+        self.metrics_host = getattr(config, 'metrics_host', '127.0.0.1')
+        self.metrics_port = getattr(config, 'metrics_port', None)
+        self.metrics_snapshot_file = getattr(config, 'metrics_snapshot_file', None)
+        self.metrics_snapshot_interval = getattr(config, 'metrics_snapshot_interval', 60.0)
 
     def initialize_handler(self, config):
         handler_module = importlib.import_module(f"api.{config.handler_class.lower()}")
         HandlerClass = getattr(handler_module, config.handler_class)
         from inspect import signature
-        sig = signature(HandlerClass.__init__)
-        handler_kwargs = {k: getattr(config, k) for k in sig.parameters.keys() if hasattr(config, k)}
-    
+        # Include the parameters of base class initializers, subclasses pass them on through **kwargs.
+        parameters = set()
+        for cls in HandlerClass.__mro__:
+            if '__init__' in cls.__dict__ and cls is not object:
+                parameters.update(signature(cls.__init__).parameters.keys())
+        handler_kwargs = {k: getattr(config, k) for k in parameters if hasattr(config, k)}
+
+        shard_workers = getattr(config, 'shard_workers', 0)
+        if shard_workers:
+            from api.shardedhandler import ShardedHandler
+            return ShardedHandler(handler_module.__name__, config.handler_class, handler_kwargs, shard_workers, call_timeout=getattr(config, 'shard_call_timeout', 600.0))
         return HandlerClass(**handler_kwargs)
     
-    def run(self):
+    def create_app(self):
         app = Client(self.ai_name, api_id=self.api_id, api_hash=self.api_hash, bot_token=self.bot_token)
         allowed_user_ids = list(self.allowed_users.values())
         self.log.info(f"init handler for {self.ai_name}")
         app.add_handler(handlers.MessageHandler(self.reset_user_thread, filters.command("reset") & filters.user(allowed_user_ids)))
         app.add_handler(handlers.MessageHandler(self.handle_messages, filters.text & filters.user(allowed_user_ids)))
+        if self.training_data is not None:
+            app.add_handler(handlers.CallbackQueryHandler(self.handle_reaction, filters.user(allowed_user_ids)))
+        return app
 
-        app.run()
+    def run(self):
+        run_bots([self])
+
+    async def start(self):
+        # Clients are created on the running loop, Pyrogram binds to the loop current at creation.
+        self.app = self.create_app()
+        started = time.perf_counter()
+
+        async def connect():
+            await self.app.start()
+            self.startup_timings['telegram'] = time.perf_counter() - started
+
+        # Warm up the handler while Pyrogram connects, so the first reply does not load the tokenizer.
+        _, warmup_timings = await asyncio.gather(connect(), self.handler.warmup())
+        self.startup_timings.update(warmup_timings)
+        self.startup_timings['start'] = time.perf_counter() - started
+        phases = ", ".join(f"{phase} {seconds:.3f}s" for phase, seconds in self.startup_timings.items())
+        self.log.info(f"Started {self.ai_name} ({phases}; warmup runs concurrently with the telegram connection)")
+
+    async def stop(self):
+        try:
+            await self.scheduler.close()
+            await self.app.stop()
+        finally:
+            await self.shutdown()
+
+    async def shutdown(self):
+        self.log.info(f"Shutting down {self.ai_name}")
+        await self.handler.close()
+        await self.chat_log.close()
+        if self.training_data is not None:
+            await self.training_data.close()
 
     async def handle_messages(self, client, message):
-        message_id = str(message.id)
-        if message_id in self.processing_messages:
-            self.log.warning(f"Skipping reprocessing of message {message_id}")
+        message_key = (message.chat.id, message.id)
+        if message_key in self.processing_messages:
+            self.log.warning(f"Skipping reprocessing of message {message.id}")
+            return
+        reply = self.replies.get(message_key) if self.replies is not None else None
+        if reply is not None:
+            self.log.warning(f"Replaying stored reply to redelivered message {message.id}")
+            for offset in range(0, len(reply), TELEGRAM_MESSAGE_LIMIT):
+                await message.reply_text(reply[offset:offset + TELEGRAM_MESSAGE_LIMIT])
             return
-        self.processing_messages.add(message_id)
 
         user_id = str(message.from_user.id)
-        if user_id not in self.user_locks:
-            self.user_locks[user_id] = asyncio.Lock()
+        user_name = message.from_user.first_name
+        self.log.info("Received message from user: %s %s" % (user_name, user_id))
+        metrics.increment("messages_received_total")
+
+        user_input = format_user_input(user_name, message.text)
+        if not self.scheduler.submit(user_id, (message, user_name, user_input)):
+            self.log.warning(f"Shedding message from user {user_name}, scheduler stats: {self.scheduler.stats()}")
+            await message.reply_text(self.busy_message)
+            return
+        self.processing_messages.add(message_key)
 
+    async def process_messages(self, user_id, batch):
+        message, user_name, _ = batch[-1]
         try:
-            async with self.user_locks[user_id]:
-                user_name = message.from_user.first_name
-                self.log.info("Received message from user: %s %s" % (user_name, user_id))
-                
-                if self.debug:
-                    self.log.debug(f"Debug Enabled - User ID: {user_id}, User Name: {user_name}, Message ID: {message.id}")
-                    await message.reply_text(f"Bot is currenlty in debug mode, AI responses will not be generated. User ID: {user_id}, User Name: {user_name}")
-                    return
-
-                user_input = format_user_input(user_name, message.text)
-                self.save_log(user_input, user_name)
-                
-                try:
-                    response = await self.handler.get_ai_response(user_input, {user_id: user_name})
-                    self.save_log(response, user_name)
-                except Exception as e:
-                    error_message = str(e)
-                    self.log.error(f"Error getting response: {error_message}")
-                    response = "An error occurred."
-                    self.save_log(error_message, user_name, error=True)
-                
-                await message.reply_text(response)
-                self.log.info(f"Sent response to user {user_name}")
+            if len(batch) > 1:
+                self.log.info(f"Coalesced {len(batch)} messages from user {user_name}")
+            with metrics.span("turn"):
+                response = await self.respond(message, user_id, user_name, [user_input for _, _, user_input in batch])
+            if response and self.replies is not None:
+                for queued_message, _, _ in batch:
+                    self.replies.put((queued_message.chat.id, queued_message.id), response)
         finally:
-            self.processing_messages.remove(message_id)
-    
+            for queued_message, _, _ in batch:
+                self.processing_messages.discard((queued_message.chat.id, queued_message.id))
+            self.log.debug(f"Scheduler stats: {self.scheduler.stats()}")
+
+    async def respond(self, message, user_id, user_name, user_inputs):
+        """
+        Answers the user's inputs and returns the reply, or None when no reply was generated.
+        """
+        if self.debug:
+            self.log.debug(f"Debug Enabled - User ID: {user_id}, User Name: {user_name}, Message ID: {message.id}")
+            await message.reply_text(f"Bot is currenlty in debug mode, AI responses will not be generated. User ID: {user_id}, User Name: {user_name}")
+            return None
+
+        for user_input in user_inputs:
+            self.save_log(user_input, user_name)
+        user_input = "\n".join(user_inputs)
+
+        if getattr(self.handler, 'stream', False):
+            response = None
+            try:
+                response, sent = await self.stream_reply(message, self.handler.stream_ai_response(user_input, {user_id: user_name}), self.reaction_markup)
+                self.remember_reply(sent, response)
+                self.save_log(response, user_name)
+            except Exception as e:
+                error_message = str(e)
+                self.log.error(f"Error streaming response: {error_message}")
+                self.save_log(error_message, user_name, error=True)
+                await message.reply_text("An error occurred.")
+            self.log.info(f"Sent response to user {user_name}")
+            return response
+
+        try:
+            response = await self.handler.get_ai_response(user_input, {user_id: user_name})
+            self.save_log(response, user_name)
+        except Exception as e:
+            error_message = str(e)
+            self.log.error(f"Error getting response: {error_message}")
+            await message.reply_text("An error occurred.")
+            self.save_log(error_message, user_name, error=True)
+            return None
+
+        with metrics.span("telegram_send"):
+            sent = await message.reply_text(response, reply_markup=self.reaction_markup)
+        self.remember_reply(sent, response)
+        self.log.info(f"Sent response to user {user_name}")
+        return response
+
+    async def stream_reply(self, message, deltas, reply_markup=None):
+        """
+        Sends the reply as soon as the first delta arrives and edits it at most once per
+        stream_edit_interval as more text comes in. Text past Telegram's message limit
+        continues in a new message. reply_markup is attached to the last message once the
+        reply is complete. Returns the full reply text and the last message sent.
+        """
+        started = time.monotonic()
+        text = ""
+        offset = 0
+        current = None
+        shown = ""
+        last_edit = 0.0
+
+        async def flush():
+            nonlocal offset, current, shown, last_edit
+            while len(text) - offset > TELEGRAM_MESSAGE_LIMIT:
+                await show(text[offset:offset + TELEGRAM_MESSAGE_LIMIT])
+                current, shown = None, ""
+                offset += TELEGRAM_MESSAGE_LIMIT
+            await show(text[offset:])
+            last_edit = time.monotonic()
+
+        async def show(part):
+            nonlocal current, shown
+            if not part.strip() or part == shown:
+                return
+            try:
+                with metrics.span("telegram_send"):
+                    if current is None:
+                        current = await message.reply_text(part)
+                    else:
+                        await current.edit_text(part)
+                shown = part
+            except Exception as e:
+                self.log.warning(f"Error updating streamed reply: {e}")
+
+        async for delta in deltas:
+            if not text:
+                self.log.info(f"Time to first token: {time.monotonic() - started:.3f}s")
+                metrics.observe("time_to_first_token_seconds", time.monotonic() - started)
+            text += delta
+            if current is None or time.monotonic() - last_edit >= self.stream_edit_interval or len(text) - offset > TELEGRAM_MESSAGE_LIMIT:
+                await flush()
+        await flush()
+        if not text:
+            await message.reply_text("No response.")
+        elif reply_markup is not None and current is not None:
+            try:
+                await current.edit_reply_markup(reply_markup)
+            except Exception as e:
+                self.log.warning(f"Error adding reactions to streamed reply: {e}")
+        self.log.info(f"Streamed reply completed in {time.monotonic() - started:.3f}s")
+        return text, current
+
+    def remember_reply(self, sent, response):
+        if self.liked_replies is not None and sent is not None and response:
+            self.liked_replies.put((sent.chat.id, sent.id), response)
+
     async def reset_user_thread(self, client, message):
         user_id = str(message.from_user.id)
         self.log.info("Received reset command from user: %s", user_id)
         await self.handler.reset_thread(user_id)
         await message.reply_text("Your conversation has been reset.")
     
-    async def handle_reaction(self, client, message):
-        self.log.debug(f"Received reaction from user: {message.from_user.first_name}")
-        if message.data not in ["like", "fire"]:
+    async def handle_reaction(self, client, callback_query):
+        """
+        Saves the liked reply together with the user turn that prompted it, both taken from
+        the handler's memory of the conversation, as a training example.
+        """
+        user_id = str(callback_query.from_user.id)
+        user_name = callback_query.from_user.first_name
+        self.log.debug(f"Received reaction from user: {user_name}")
+        if callback_query.data not in REACTIONS:
             return
-        
-        chat_id = message.chat.id
-        message_id = message.id
-        callback_message = await client.get_messages(chat_id, message_ids=message_id)
-        if not callback_message.from_user or not callback_message.from_user.is_self:
+
+        reply = callback_query.message
+        if reply is None:
+            await callback_query.answer()
+            return
+        messages = None
+        response = self.liked_replies.get((reply.chat.id, reply.id))
+        if response is not None:
+            try:
+                messages = await self.handler.get_training_example(user_id, user_name, response)
+            except Exception as e:
+                self.log.error(f"Error finding the turn of reaction from user {user_name}: {e}")
+        if messages is None:
+            self.log.info(f"Reaction from user {user_name} on message {reply.id} is not in memory anymore, skipping")
+            await callback_query.answer("That reply is too old to save.")
             return
-        
-        user_name = message.from_user.first_name
-        user_message = await client.get_messages(chat_id, message_ids=message_id - 1)
-        
-        bot_message_text = callback_message.text
-        user_message_text = user_message.text if user_message else "Previous message not found."
 
-        self.log.info(f"Positive reaction from user {user_name} on message {message_id}")
-        self.handler.save_training_data(user_message_text, bot_message_text, user_name)
-        
-        await message.answer()  # Acknowledge the callback to Telegram
+        self.log.info(f"Positive reaction from user {user_name} on message {reply.id}")
+        self.training_data.write(user_name, callback_query.data, messages, user_id=user_id, ai_name=self.ai_name)
+        await callback_query.answer("Thanks for the feedback!")
 
     def save_log(self, text, user_name, error=False):
-        log_dir = os.path.join(self.log_directory, user_name)
-        os.makedirs(log_dir, exist_ok=True)
-        iso_datetime = datetime.now().strftime('%Y%m%d')
-        chat_log = os.path.join(log_dir, f"chat_{iso_datetime}.txt")
-        error_log = os.path.join(log_dir, f"errors_{iso_datetime}.txt")
+        self.chat_log.write(user_name, text, error)
+
+async def serve(bots):
+    """
+    Runs the bots on the current event loop until the process is asked to stop. Bots share
+    provider clients, connection pools, rate limiters and the tokenizer and template caches;
+    each keeps its own user threads and logs. Metrics are served once per process, using the
+    settings of the first config that enables them.
+    """
+    metrics_bot = next((bot for bot in bots if bot.metrics_port or bot.metrics_snapshot_file), None)
+    if metrics_bot is not None:
+        await metrics.registry.start(metrics_bot.metrics_host, metrics_bot.metrics_port, metrics_bot.metrics_snapshot_file, metrics_bot.metrics_snapshot_interval)
+    results = await asyncio.gather(*(bot.start() for bot in bots), return_exceptions=True)
+    started = [bot for bot, result in zip(bots, results) if not isinstance(result, BaseException)]
+    try:
+        for bot, result in zip(bots, results):
+            if isinstance(result, BaseException):
+                raise result
+        await idle()
+    finally:
+        results = await asyncio.gather(*(bot.stop() for bot in started), return_exceptions=True)
+        for bot, result in zip(started, results):
+            if isinstance(result, BaseException):
+                logging.getLogger(__name__).error(f"Error stopping {bot.ai_name}: {result}")
+        await close_clients()
+        await metrics.registry.stop()
 
-        file_path = error_log if error else chat_log
-        with open(file_path, "a", encoding="utf-8") as file:
-            file.write(text + "\n" + "\n")
+def run_bots(bots):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(serve(bots))
+    finally:
+        loop.close()
 
-def main(config_module_name):
-    bot = TelegramBot(config_module_name)
-    bot.run()
+def main(config_module_names):
+    bots = [TelegramBot(config_module_name) for config_module_name in config_module_names]
+    ai_names = [bot.ai_name for bot in bots]
+    duplicates = {ai_name for ai_name in ai_names if ai_names.count(ai_name) > 1}
+    if duplicates:
+        # The ai_name names the Pyrogram session and the user thread store, so it has to be unique.
+        raise ValueError(f"Each bot needs its own ai_name, found duplicates: {', '.join(sorted(duplicates))}")
+    run_bots(bots)
 
 if __name__ == "__main__":
     if len(sys.argv) < 2:
-        print("Usage: python telegram_bot.py <config_module>")
+        print("Usage: python telegram_bot.py <config_module> [<config_module> ...]")
         sys.exit(1)
 
-    main(sys.argv[1])
\ No newline at end of file
+    main(sys.argv[1:])
@@ -0,0 +1,169 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sys
+from datetime import datetime
+
+def example_key(messages):
+    # System messages change with template edits, the same exchange is only kept once.
+    turns = [(message['role'], message['content']) for message in messages if message['role'] != 'system']
+    return hashlib.sha1(json.dumps(turns, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+def read_records(path):
+    """
+    Yields the records of a JSONL file one line at a time, skipping lines that do not parse.
+    """
+    with open(path, "r", encoding="utf-8") as file:
+        for line_number, line in enumerate(file, 1):
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                logging.getLogger(__name__).warning(f"Skipping malformed line {line_number} of {path}")
+
+def load_keys(path):
+    if not os.path.exists(path):
+        return set()
+    return {record.get('id') or example_key(record['messages']) for record in read_records(path)}
+
+class TrainingDataWriter:
+    """
+    Appends training examples to a JSONL file. Records are buffered and written in batches of
+    batch_size, or every flush_interval seconds, from an executor. Examples already in the file
+    are skipped, by a hash of their user and assistant messages.
+    """
+    def __init__(self, path, batch_size=50, flush_interval=5.0):
+        self.log = logging.getLogger(__name__)
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.buffer = []
+        self.seen = None
+        self.wakeup = None
+        self.stopping = False
+        self.task = None
+
+    def write(self, user_name, reaction, messages, **fields):
+        if self.task is None:
+            self.wakeup = asyncio.Event()
+            self.stopping = False
+            self.task = asyncio.create_task(self._run())
+        record = {
+            'time': datetime.now().astimezone().isoformat(),
+            'user': user_name,
+            'reaction': reaction,
+            **fields,
+            'messages': messages
+        }
+        self.buffer.append(record)
+        if len(self.buffer) >= self.batch_size:
+            self.wakeup.set()
+
+    async def _run(self):
+        await self.load_seen()
+        while not self.stopping:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            await self.flush()
+        await self.flush()
+
+    async def load_seen(self):
+        try:
+            self.seen = await asyncio.get_running_loop().run_in_executor(None, load_keys, self.path)
+        except Exception as e:
+            self.log.error(f"Error reading training data from {self.path}: {e}")
+            self.seen = set()
+
+    async def flush(self):
+        batch, self.buffer = self.buffer, []
+        records = []
+        for record in batch:
+            key = example_key(record['messages'])
+            if key in self.seen:
+                continue
+            self.seen.add(key)
+            records.append({'id': key, **record})
+        if not records:
+            return
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self.append, records)
+            self.log.info(f"Saved {len(records)} training examples to {self.path}")
+        except Exception as e:
+            self.log.error(f"Error writing training data to {self.path}: {e}")
+
+    def append(self, records):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.path, "a", encoding="utf-8") as file:
+            file.writelines(json.dumps(record, ensure_ascii=False) + "\n" for record in records)
+
+    async def close(self):
+        if self.task is None:
+            return
+        # The task finishes its running flush and writes what is left, only one append runs at a time.
+        self.stopping = True
+        self.wakeup.set()
+        await self.task
+        self.task = None
+
+def validation_path(destination):
+    root, extension = os.path.splitext(destination)
+    return f"{root}.validation{extension or '.jsonl'}"
+
+def export(source, destination, validation_split=0.0, include_system=True):
+    """
+    Streams the captured records of source into destination in the chat fine-tuning format,
+    one {"messages": [...]} object per line, dropping duplicates. With a validation_split, that
+    share of the examples goes to a separate validation file, picked by their hash so repeated
+    exports split the same way. Only the hashes of the examples are kept in memory.
+    """
+    seen = set()
+    counts = {'train': 0, 'validation': 0, 'duplicates': 0}
+    validation = open(validation_path(destination), "w", encoding="utf-8") if validation_split > 0 else None
+    try:
+        with open(destination, "w", encoding="utf-8") as train:
+            for record in read_records(source):
+                messages = record.get('messages')
+                if not messages:
+                    continue
+                key = record.get('id') or example_key(messages)
+                if key in seen:
+                    counts['duplicates'] += 1
+                    continue
+                seen.add(key)
+                if not include_system:
+                    messages = [message for message in messages if message['role'] != 'system']
+                line = json.dumps({'messages': messages}, ensure_ascii=False) + "\n"
+                if validation is not None and int(key[:8], 16) / 0xffffffff < validation_split:
+                    validation.write(line)
+                    counts['validation'] += 1
+                else:
+                    train.write(line)
+                    counts['train'] += 1
+    finally:
+        if validation is not None:
+            validation.close()
+    return counts
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Export captured training data as fine-tuning files.")
+    parser.add_argument("source", help="training data file written by the bot, the training_data_file config option")
+    parser.add_argument("destination", help="fine-tuning file to write")
+    parser.add_argument("--validation-split", type=float, default=0.0, help="share of the examples written to <destination>.validation.jsonl")
+    parser.add_argument("--no-system", action="store_true", help="leave out the system message of each example")
+    args = parser.parse_args(argv)
+    if not 0.0 <= args.validation_split < 1.0:
+        parser.error("--validation-split must be at least 0 and below 1")
+    counts = export(args.source, args.destination, args.validation_split, not args.no_system)
+    print(f"Exported {counts['train']} training and {counts['validation']} validation examples, skipped {counts['duplicates']} duplicates")
+
+if __name__ == "__main__":
+    main(sys.argv[1:])